@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# License: GNU LGPL v3
+"""
+Benchmark timetable's hot paths on synthetic timetables
+
+Usage: bench [-h] [-s SIZES] [-r REPEAT] [-o FILE] [-c BASELINE]
+             [-t TOLERANCE] [-b BUDGET] [BENCH...]
+
+Arguments:
+    BENCH      Only run the benchmarks whose name starts with BENCH
+               Default is to run all of them
+
+Options:
+    -h, --help                  Print this help and exit
+    -s, --sizes SIZES           Comma separated numbers of courses
+                                [default: 100,1000,10000,100000,1000000]
+    -r, --repeat REPEAT         Timings kept for each benchmark, the best
+                                one is reported [default: 5]
+    -o, --output FILE           Write the JSON results to FILE instead of
+                                the standard output
+    -c, --compare BASELINE      Compare with the JSON results of a previous
+                                run and fail if a benchmark got slower
+    -t, --tolerance TOLERANCE   Slowdown ratio allowed by --compare
+                                [default: 0.2]
+    -b, --budget BUDGET         Fail if the cold start of a cached query
+                                takes more than BUDGET seconds
+
+Examples:
+    bench -o before.json
+    bench -s 1000 -c before.json filter_dates print_courses
+"""
+
+import os
+import sys
+import re
+import json
+import time
+import random
+import timeit
+import shutil
+import platform
+import datetime
+import tempfile
+import subprocess
+import docopt
+
+import timetable
+
+
+HERE      = os.path.dirname(os.path.abspath(__file__))
+TITLES    = ["Algorithms", "Databases", "Networks", "Compilers", "English",
+             "Operating systems", "Statistics", "Management"]
+TEACHERS  = ["Smith", "Martin", "Bernard", "Dubois", "Durand"]
+ROOMS     = ["A%d" % i for i in range(1, 13)] + ["Amphi"]
+
+# Courses of a synthetic day, one hour each
+DAY_START = 8
+PER_DAY   = 10
+
+SELECTORS = [None, "current", "next", "previous", "today", "tomorrow",
+             "first", "5", "week", "next-week room:A1 or title:~^algo"]
+
+
+def synthetic(size, seed=0):
+    """
+    Returns size courses as the extranet sends them: dicts with datetimes,
+    in no particular order, spread over the days around today.
+    """
+    rand  = random.Random(seed)
+    today = datetime.date.today()
+    first = today - datetime.timedelta(days=size // PER_DAY // 2)
+
+    courses = []
+    for i in range(size):
+        day   = first + datetime.timedelta(days=i // PER_DAY)
+        start = datetime.datetime.combine(day, datetime.time(DAY_START)) \
+              + datetime.timedelta(hours=i % PER_DAY)
+        courses.append({"title":   rand.choice(TITLES),
+                        "teacher": rand.choice(TEACHERS),
+                        "room":    rand.choice(ROOMS),
+                        "start":   start,
+                        "end":     start + datetime.timedelta(hours=1)})
+
+    rand.shuffle(courses)
+    return courses
+
+
+def benchmarks(size, workdir):
+    """
+    Yields (name, function) for each benchmark on a timetable of size
+    courses, the setup being done beforehand.
+    """
+    raw     = synthetic(size)
+    courses = timetable.normalize(raw)
+    path    = os.path.join(workdir, "%d.store" % size)
+    timetable.Store.save(path, courses, time.time())
+    store   = timetable.Store(path)
+    index   = timetable.TimetableIndex(store)
+    now     = index.now
+    day     = datetime.date.fromtimestamp(now) + datetime.timedelta(days=2)
+
+    yield "normalize", lambda: timetable.normalize(raw)
+    # Not the mapped file, which must not be truncated under store
+    copy    = os.path.join(workdir, "%d.copy.store" % size)
+    yield "store.save", lambda: timetable.Store.save(copy, courses, now)
+    yield "index", lambda: timetable.TimetableIndex(timetable.Store(path))
+
+    for selection in SELECTORS + ["%d/%d" % (day.day, day.month)]:
+        name = "filter_dates:%s" % ("all" if selection is None
+                                    else re.sub(r"[/ ]", "-", selection))
+        yield name, lambda s=selection: timetable.filter_dates(index, s)
+
+    ranges = {"current":  ("start", "end"),
+              "next":     (now, "start"),
+              "previous": ("end", now),
+              "at":       (now - 3600, now),
+              "scan":     ("start", now)}
+    for kind, (start, end) in ranges.items():
+        yield ("courses_in_range:" + kind,
+               lambda s=start, e=end: timetable.courses_in_range(s, e, 5,
+                                                                 index))
+
+    yield ("converted_dates",
+           lambda: list(timetable.converted_dates(store)))
+
+    for compact in (False, True):
+        name = "print_courses:" + ("compact" if compact else "full")
+        yield name, lambda c=compact: render(store, c)
+
+
+def render(courses, compact):
+    with open(os.devnull, "w") as f:
+        timetable.print_courses(courses, compact=compact, file=f)
+
+
+def fixed_benchmarks(workdir):
+    """
+    Yields (name, function) for the benchmarks not depending on the size
+    of the timetable.
+    """
+    argv = ["-c", "today", "next"]
+
+    yield ("docopt",
+           lambda: docopt.docopt(timetable.__doc__, argv, help=False))
+    # Warm the on-disk parser cache first, as a second run would
+    docopt.compile(timetable.__doc__, cache_dir=workdir)
+    yield ("docopt:cached",
+           lambda: docopt.compile(timetable.__doc__,
+                                  cache_dir=workdir)(argv, help=False))
+    yield "cold_start", lambda: cold_start(workdir)
+
+
+def cold_start(workdir):
+    """
+    Runs a whole offline query from a cached timetable in a new process.
+    """
+    env = dict(os.environ, HOME=workdir, XDG_CACHE_HOME=workdir)
+    subprocess.run([sys.executable, os.path.join(HERE, "timetable.py"),
+                    "-o", "next"],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def prepare_cold_start(workdir):
+    """
+    Writes the credential file and cached timetable read by cold_start.
+    """
+    with open(os.path.join(workdir, ".extranet"), "w") as f:
+        f.write("bench\nhttp://localhost\n")
+
+    path = os.path.join(workdir, "timetable",
+                        os.path.basename(timetable.cache_path(
+                            "bench", "http://localhost")))
+    timetable.save_cache(path, timetable.normalize(synthetic(1000)))
+
+
+def measure(function, repeat):
+    """
+    Returns the best and median time of one call, in seconds.
+    """
+    timer     = timeit.Timer(function)
+    number, _ = timer.autorange()
+    timings   = sorted(t / number for t in timer.repeat(repeat, number))
+    return timings[0], timings[len(timings) // 2], number
+
+
+def run(selected, sizes, repeat, workdir):
+    wanted = lambda name: not selected or any(name.startswith(s)
+                                              for s in selected)
+    results = []
+
+    def record(name, size, function):
+        best, median, number = measure(function, repeat)
+        results.append({"name":   name,
+                        "size":   size,
+                        "best":   best,
+                        "median": median,
+                        "number": number,
+                        "repeat": repeat})
+        print("%-28s %8s %12.6fs" % (name, size or "-", best),
+              file=sys.stderr)
+
+    prepare_cold_start(workdir)
+    for name, function in fixed_benchmarks(workdir):
+        if wanted(name):
+            record(name, None, function)
+
+    # Skip generating the timetables when none of their benchmarks is run
+    if not any(wanted(name) for name, _ in benchmarks(0, workdir)):
+        sizes = []
+
+    for size in sizes:
+        for name, function in benchmarks(size, workdir):
+            if wanted(name):
+                record(name, size, function)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the ratio to the baseline of each benchmark, and returns the
+    names of those slower than allowed.
+    """
+    before  = {(r["name"], r["size"]): r["best"] for r in baseline["results"]}
+    slower  = []
+
+    for r in results:
+        key = (r["name"], r["size"])
+        if key not in before:
+            continue
+        ratio = r["best"] / before[key]
+        flag  = ""
+        if ratio > 1 + tolerance:
+            flag = "  SLOWER"
+            slower.append("%s (%s)" % key)
+        print("%-28s %8s %8.2fx%s" % (r["name"], r["size"] or "-", ratio,
+                                      flag), file=sys.stderr)
+
+    return slower
+
+
+def main():
+    args = docopt.docopt(__doc__)
+
+    sizes   = [int(size) for size in args["--sizes"].split(",")]
+    workdir = tempfile.mkdtemp(prefix="timetable-bench-")
+    try:
+        results = run(args["BENCH"], sizes, int(args["--repeat"]), workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"python":   platform.python_version(),
+              "platform": platform.platform(),
+              "date":     time.time(),
+              "results":  results}
+
+    if args["--output"] is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args["--output"], "w") as f:
+            json.dump(report, f, indent=1)
+
+    failed = []
+    if args["--compare"] is not None:
+        with open(args["--compare"]) as f:
+            baseline = json.load(f)
+        failed += compare(results, baseline, float(args["--tolerance"]))
+
+    if args["--budget"] is not None:
+        failed += ["cold_start (%.3fs)" % r["best"] for r in results
+                   if r["name"] == "cold_start"
+                   and r["best"] > float(args["--budget"])]
+
+    if failed:
+        sys.exit("Too slow: " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
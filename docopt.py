@@ -6,11 +6,16 @@
  * Copyright (c) 2013 Vladimir Keleshev, vladimir@keleshev.com
 
 """
-import sys
+import os
 import re
+import sys
+import copy
+import pickle
+import hashlib
+import tempfile
 
 
-__all__ = ['docopt']
+__all__ = ['docopt', 'Parser']
 __version__ = '0.6.1'
 
 
@@ -37,6 +42,15 @@ class Pattern(object):
     def __hash__(self):
         return hash(repr(self))
 
+    def match(self, left, collected=None):
+        """Match parsed argv `left`, returning (matched, left, collected)."""
+        collected = [] if collected is None else collected
+        matcher = Matcher(left)
+        matched, state, events = matcher.match(self, matcher.start)
+        if not matched:
+            return False, left, collected
+        return True, matcher.left(state), matcher.collect(events, collected)
+
     def fix(self):
         self.fix_identities()
         self.fix_repeating_arguments()
@@ -56,44 +70,46 @@ class Pattern(object):
 
     def fix_repeating_arguments(self):
         """Fix elements that should accumulate/increment values."""
-        either = [list(child.children) for child in transform(self).children]
-        for case in either:
-            for e in [child for child in case if case.count(child) > 1]:
-                if type(e) is Argument or type(e) is Option and e.argcount:
-                    if e.value is None:
-                        e.value = []
-                    elif type(e.value) is not list:
-                        e.value = e.value.split()
-                if type(e) is Command or type(e) is Option and e.argcount == 0:
-                    e.value = 0
+        for e in repeating(self):
+            if type(e) is Argument or type(e) is Option and e.argcount:
+                if e.value is None:
+                    e.value = []
+                elif type(e.value) is not list:
+                    e.value = e.value.split()
+            if type(e) is Command or type(e) is Option and e.argcount == 0:
+                e.value = 0
         return self
 
 
-def transform(pattern):
-    """Expand pattern into an (almost) equivalent one, but with single Either.
+def repeating(pattern):
+    """Leaves occurring more than once in some case of pattern.
 
-    Example: ((-a | -b) (-c | -d)) => (-a -c | -a -d | -b -c | -b -d)
-    Quirks: [-a] => (-a), (-a...) => (-a -a)
+    The cases are those of pattern with each Either replaced by one of
+    its branches and each OneOrMore repeated twice. Instead of expanding
+    every case, which grows exponentially with the number of optional
+    or alternative groups, a single walk of the tree finds, for each
+    node, its leaves and those that may occur twice:
+    a sequence repeats what one of its children repeats or what two of
+    them contain, an Either what one of its branches repeats, and
+    OneOrMore everything it contains.
 
     """
-    result = []
-    groups = [[pattern]]
-    while groups:
-        children = groups.pop(0)
-        parents = [Required, Optional, OptionsShortcut, Either, OneOrMore]
-        if any(t in map(type, children) for t in parents):
-            child = [c for c in children if type(c) in parents][0]
-            children.remove(child)
-            if type(child) is Either:
-                for c in child.children:
-                    groups.append([c] + children)
-            elif type(child) is OneOrMore:
-                groups.append(child.children * 2 + children)
-            else:
-                groups.append(child.children + children)
-        else:
-            result.append(children)
-    return Either(*[Required(*e) for e in result])
+    return list(_leaves_and_repeating(pattern)[1])
+
+
+def _leaves_and_repeating(pattern):
+    if not hasattr(pattern, 'children'):
+        return {pattern}, set()
+    leaves, repeated = set(), set()
+    for child in pattern.children:
+        child_leaves, child_repeated = _leaves_and_repeating(child)
+        repeated |= child_repeated
+        if type(pattern) is not Either:
+            repeated |= leaves & child_leaves
+        leaves |= child_leaves
+    if type(pattern) is OneOrMore:
+        repeated |= leaves
+    return leaves, repeated
 
 
 class LeafPattern(Pattern):
@@ -109,25 +125,23 @@ class LeafPattern(Pattern):
     def flat(self, *types):
         return [self] if not types or type(self) in types else []
 
-    def match(self, left, collected=None):
-        collected = [] if collected is None else collected
-        pos, match = self.single_match(left)
-        if match is None:
-            return False, left, collected
-        left_ = left[:pos] + left[pos + 1:]
-        same_name = [a for a in collected if a.name == self.name]
-        if type(self.value) in (int, list):
-            if type(self.value) is int:
-                increment = 1
-            else:
-                increment = ([match.value] if type(match.value) is str
-                             else match.value)
-            if not same_name:
-                match.value = increment
-                return True, left_, collected + [match]
-            same_name[0].value += increment
-            return True, left_, collected
-        return True, left_, collected + [match]
+    def _match(self, matcher, state):
+        n = self.single_match(matcher, state)
+        if n is None:
+            return False, state, None
+        return True, matcher.consume(state, n), (self, n)
+
+    def first(self):
+        """Return (leads, consumes_argument, required_options).
+
+        `leads` are the values the first Argument consumed by this
+        pattern may take (None standing for any value),
+        `consumes_argument` tells if every match consumes an Argument
+        and `required_options` are the names of Options every match
+        consumes. This is what Either dispatches on.
+
+        """
+        return set(), False, set()
 
 
 class BranchPattern(Pattern):
@@ -149,11 +163,14 @@ class BranchPattern(Pattern):
 
 class Argument(LeafPattern):
 
-    def single_match(self, left):
-        for n, pattern in enumerate(left):
-            if type(pattern) is Argument:
-                return n, Argument(self.name, pattern.value)
-        return None, None
+    def single_match(self, matcher, state):
+        return matcher.peek(state, Argument)
+
+    def matched(self, token):
+        return Argument(self.name, token.value)
+
+    def first(self):
+        return {None}, True, set()
 
     @classmethod
     def parse(class_, source):
@@ -167,14 +184,17 @@ class Command(Argument):
     def __init__(self, name, value=False):
         self.name, self.value = name, value
 
-    def single_match(self, left):
-        for n, pattern in enumerate(left):
-            if type(pattern) is Argument:
-                if pattern.value == self.name:
-                    return n, Command(self.name, True)
-                else:
-                    break
-        return None, None
+    def single_match(self, matcher, state):
+        n = matcher.peek(state, Argument)
+        if n is not None and matcher.tokens[n].value == self.name:
+            return n
+        return None
+
+    def matched(self, token):
+        return Command(self.name, True)
+
+    def first(self):
+        return {self.name}, True, set()
 
 
 class Option(LeafPattern):
@@ -201,11 +221,14 @@ class Option(LeafPattern):
             value = matched[0] if matched else None
         return class_(short, long, argcount, value)
 
-    def single_match(self, left):
-        for n, pattern in enumerate(left):
-            if self.name == pattern.name:
-                return n, pattern
-        return None, None
+    def single_match(self, matcher, state):
+        return matcher.peek(state, self.name)
+
+    def matched(self, token):
+        return token
+
+    def first(self):
+        return set(), False, {self.name}
 
     @property
     def name(self):
@@ -218,24 +241,41 @@ class Option(LeafPattern):
 
 class Required(BranchPattern):
 
-    def match(self, left, collected=None):
-        collected = [] if collected is None else collected
-        l = left
-        c = collected
+    def _match(self, matcher, state):
+        events = None
+        current = state
         for pattern in self.children:
-            matched, l, c = pattern.match(l, c)
+            matched, current, child_events = matcher.match(pattern, current)
             if not matched:
-                return False, left, collected
-        return True, l, c
+                return False, state, None
+            events = join(events, child_events)
+        return True, current, events
+
+    def first(self):
+        leads, consumes, required = set(), False, set()
+        for pattern in self.children:
+            child_leads, child_consumes, child_required = pattern.first()
+            if not consumes:
+                leads |= child_leads
+            consumes = consumes or child_consumes
+            required |= child_required
+        return leads, consumes, required
 
 
 class Optional(BranchPattern):
 
-    def match(self, left, collected=None):
-        collected = [] if collected is None else collected
+    def _match(self, matcher, state):
+        events = None
         for pattern in self.children:
-            m, left, collected = pattern.match(left, collected)
-        return True, left, collected
+            matched, state, child_events = matcher.match(pattern, state)
+            events = join(events, child_events)
+        return True, state, events
+
+    def first(self):
+        leads = set()
+        for pattern in self.children:
+            leads |= pattern.first()[0]
+        return leads, False, set()
 
 
 class OptionsShortcut(Optional):
@@ -245,44 +285,183 @@ class OptionsShortcut(Optional):
 
 class OneOrMore(BranchPattern):
 
-    def match(self, left, collected=None):
+    def _match(self, matcher, state):
         assert len(self.children) == 1
-        collected = [] if collected is None else collected
-        l = left
-        c = collected
-        l_ = None
-        matched = True
+        events = None
         times = 0
-        while matched:
-            # could it be that something didn't match but changed l or c?
-            matched, l, c = self.children[0].match(l, c)
-            times += 1 if matched else 0
-            if l_ == l:
+        while True:
+            matched, next_state, child_events = matcher.match(
+                self.children[0], state)
+            if not matched:
+                break
+            times += 1
+            events = join(events, child_events)
+            if next_state == state:  # matched without consuming anything
                 break
-            l_ = l
-        if times >= 1:
-            return True, l, c
-        return False, left, collected
+            state = next_state
+        return times >= 1, state, events
+
+    def first(self):
+        return self.children[0].first()
 
 
 class Either(BranchPattern):
 
-    def match(self, left, collected=None):
-        collected = [] if collected is None else collected
-        outcomes = []
+    def _match(self, matcher, state):
+        if not hasattr(self, 'dispatch'):
+            self.compile_dispatch()
+        first = matcher.peek(state, Argument)
+        first = None if first is None else matcher.tokens[first].value
+        try:
+            candidates = self.dispatch.get(first, self.dispatch[None])
+        except TypeError:  # unhashable value, only any-value branches apply
+            candidates = self.dispatch[None]
+        best = None
+        for pattern, required in candidates:
+            if not all(matcher.peek(state, name) is not None
+                       for name in required):
+                continue
+            outcome = matcher.match(pattern, state)
+            if outcome[0] and (best is None or sum(outcome[1]) > sum(best[1])):
+                best = outcome
+        return best or (False, state, None)
+
+    def compile_dispatch(self):
+        """Index the branches by the first Argument value they accept.
+
+        A branch that must consume an Argument and only accepts some
+        command names there is listed under those names only, so the
+        others are not even tried. Branch order is kept, as the first
+        branch leaving the least unmatched wins.
+
+        """
+        branches = [(p,) + p.first() for p in self.children]
+        names = set().union(*(leads for _, leads, _, _ in branches))
+        names.discard(None)
+        self.dispatch = {}
+        for name in [None] + sorted(names, key=repr):
+            self.dispatch[name] = [
+                (pattern, required)
+                for pattern, leads, consumes, required in branches
+                if not consumes or None in leads or name in leads]
+
+    def __getstate__(self):  # the dispatch table is rebuilt when needed
+        state = dict(self.__dict__)
+        state.pop('dispatch', None)
+        return state
+
+    def first(self):
+        leads, consumes, required = set(), True, None
         for pattern in self.children:
-            matched, _, _ = outcome = pattern.match(left, collected)
-            if matched:
-                outcomes.append(outcome)
-        if outcomes:
-            return min(outcomes, key=lambda outcome: len(outcome[1]))
-        return False, left, collected
+            child_leads, child_consumes, child_required = pattern.first()
+            leads |= child_leads
+            consumes = consumes and child_consumes
+            required = (child_required if required is None
+                        else required & child_required)
+        return leads, consumes, required or set()
+
+
+def join(events, other):
+    """Concatenate two event trees without copying them."""
+    if events is None:
+        return other
+    if other is None:
+        return events
+    return events, other
+
+
+class Matcher(object):
+
+    """Match pattern trees against one parsed argument vector.
+
+    A leaf always consumes the first unused Argument of `left`, or the
+    first unused Option of its name. The unused part of `left` is thus
+    described by a state holding one cursor per kind of token, which is
+    cheap to copy and to compare.
+
+    Matching a pattern returns (matched, state, events) where events is
+    a tree of (leaf, index in left) pairs that only `collect` turns into
+    values. The outcome only depends on the pattern and the state so it
+    is memoized per position.
+
+    """
 
+    def __init__(self, left):
+        self.tokens = left
+        self.kinds = {Argument: 0}
+        self.positions = [[]]
+        for n, token in enumerate(left):
+            kind = Argument if type(token) is Argument else token.name
+            if kind not in self.kinds:
+                self.kinds[kind] = len(self.positions)
+                self.positions.append([])
+            self.positions[self.kinds[kind]].append(n)
+        self.start = (0,) * len(self.positions)
+        self.memo = {}
+
+    def match(self, pattern, state):
+        key = id(pattern), state
+        if key not in self.memo:
+            self.memo[key] = pattern._match(self, state)
+        return self.memo[key]
+
+    def peek(self, state, kind):
+        """Index in `left` of the first unused token of `kind`, or None."""
+        k = self.kinds.get(kind)
+        if k is None or state[k] == len(self.positions[k]):
+            return None
+        return self.positions[k][state[k]]
+
+    def consume(self, state, n):
+        token = self.tokens[n]
+        k = self.kinds[Argument if type(token) is Argument else token.name]
+        return state[:k] + (state[k] + 1,) + state[k + 1:]
+
+    def left(self, state):
+        used = set()
+        for k, positions in enumerate(self.positions):
+            used.update(positions[:state[k]])
+        return [t for n, t in enumerate(self.tokens) if n not in used]
+
+    def collect(self, events, collected):
+        """Turn matched events into values, accumulating repeated ones."""
+        collected = list(collected)
+        same_name = {}
+        for a in collected:
+            same_name.setdefault(a.name, a)
+        stack = [events]
+        while stack:
+            events = stack.pop()
+            if events is None:
+                continue
+            if isinstance(events[0], LeafPattern):
+                self.accumulate(events, collected, same_name)
+            else:
+                stack.extend(reversed(events))
+        return collected
+
+    def accumulate(self, event, collected, same_name):
+        leaf, n = event
+        match = leaf.matched(self.tokens[n])
+        if type(leaf.value) in (int, list):
+            if type(leaf.value) is int:
+                increment = 1
+            else:
+                increment = ([match.value] if type(match.value) is str
+                             else match.value)
+            if leaf.name in same_name:
+                same_name[leaf.name].value += increment
+                return
+            match.value = increment
+        collected.append(match)
+        same_name.setdefault(match.name, match)
 
-class Tokens(list):
+
+class Tokens(object):
 
     def __init__(self, source, error=DocoptExit):
-        self += source.split() if hasattr(source, 'split') else source
+        self.tokens = source.split() if hasattr(source, 'split') else source
+        self.position = 0
         self.error = error
 
     @staticmethod
@@ -291,11 +470,21 @@ class Tokens(list):
         source = [s for s in re.split('\s+|(\S*<.*?>)', source) if s]
         return Tokens(source, error=DocoptLanguageError)
 
+    def __iter__(self):
+        return iter(self.tokens[self.position:])
+
+    def __len__(self):
+        return len(self.tokens) - self.position
+
     def move(self):
-        return self.pop(0) if len(self) else None
+        token = self.current()
+        self.position += token is not None
+        return token
 
     def current(self):
-        return self[0] if len(self) else None
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
 
 
 def parse_long(tokens, options):
@@ -487,6 +676,93 @@ class Dict(dict):
         return '{%s}' % ',\n '.join('%r: %r' % i for i in sorted(self.items()))
 
 
+class Parser(object):
+
+    """Usage message parsed once, able to match any number of `argv`.
+
+    All the grammar work (finding the sections, parsing the options
+    and the usage pattern, fixing identities and repeating arguments)
+    happens in the constructor. Calling the instance only parses and
+    matches the argument vector, with the same parameters as `docopt`.
+
+    """
+
+    def __init__(self, doc):
+        usage_sections = parse_section('usage:', doc)
+        if len(usage_sections) == 0:
+            raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
+        if len(usage_sections) > 1:
+            raise DocoptLanguageError('More than one "usage:" '
+                                      '(case-insensitive).')
+        self.doc = doc
+        self.usage = usage_sections[0]
+        defaults = parse_defaults(doc)
+        options = list(defaults)
+        pattern = parse_pattern(formal_usage(self.usage), options)
+        pattern_options = set(pattern.flat(Option))
+        for options_shortcut in pattern.flat(OptionsShortcut):
+            doc_options = [copy.copy(o) for o in defaults]
+            options_shortcut.children = list(set(doc_options) -
+                                             pattern_options)
+        # fix() may alter options found in the usage only, keep them intact
+        self.options = [copy.copy(o) for o in options]
+        self.pattern = pattern.fix()
+
+    def __call__(self, argv=None, help=True, version=None,
+                 options_first=False):
+        argv = sys.argv[1:] if argv is None else argv
+        DocoptExit.usage = self.usage
+        argv = parse_argv(Tokens(argv), list(self.options), options_first)
+        extras(help, version, argv, self.doc)
+        matched, left, collected = self.pattern.match(argv)
+        if matched and left == []:  # better error message if left?
+            # copy default lists, they belong to the pattern
+            return Dict((a.name, copy.copy(a.value))
+                        for a in (self.pattern.flat() + collected))
+        raise DocoptExit()
+
+
+def compile(doc, cache_dir=None):
+    """Parse `doc` once and return a reusable `Parser`.
+
+    If `cache_dir` is given, the parser is pickled there under a name
+    derived from `doc` and the source of this module so that later
+    processes can load it instead of parsing `doc` again, until either
+    changes. The directory must only be writable by trusted users as
+    loading a pickle may run arbitrary code.
+
+    """
+    if cache_dir is None:
+        return Parser(doc)
+    try:
+        with open(__file__, 'rb') as f:
+            key = hashlib.sha1(f.read())
+    except OSError:  # e.g. zipped, fall back to the release
+        key = hashlib.sha1(__version__.encode('utf-8'))
+    key.update(b'\0' + doc.encode('utf-8'))
+    path = os.path.join(cache_dir, 'docopt-%s.pickle' % key.hexdigest())
+    try:
+        with open(path, 'rb') as f:
+            parser = pickle.load(f)
+        if isinstance(parser, Parser) and parser.doc == doc:
+            return parser
+    except Exception:  # missing, truncated or outdated file
+        pass
+    parser = Parser(doc)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    except OSError:  # caching is only an optimisation
+        return parser
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(parser, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except (OSError, pickle.PicklingError):
+        os.unlink(tmp)
+    return parser
+
+
 def docopt(doc, argv=None, help=True, version=None, options_first=False):
     """Parse `argv` based on command-line interface described in `doc`.
 
@@ -550,32 +826,4 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
       at https://github.com/docopt/docopt#readme
 
     """
-    argv = sys.argv[1:] if argv is None else argv
-
-    usage_sections = parse_section('usage:', doc)
-    if len(usage_sections) == 0:
-        raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
-    if len(usage_sections) > 1:
-        raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
-    DocoptExit.usage = usage_sections[0]
-
-    options = parse_defaults(doc)
-    pattern = parse_pattern(formal_usage(DocoptExit.usage), options)
-    # [default] syntax for argument is disabled
-    #for a in pattern.flat(Argument):
-    #    same_name = [d for d in arguments if d.name == a.name]
-    #    if same_name:
-    #        a.value = same_name[0].value
-    argv = parse_argv(Tokens(argv), list(options), options_first)
-    pattern_options = set(pattern.flat(Option))
-    for options_shortcut in pattern.flat(OptionsShortcut):
-        doc_options = parse_defaults(doc)
-        options_shortcut.children = list(set(doc_options) - pattern_options)
-        #if any_options:
-        #    options_shortcut.children += [Option(o.short, o.long, o.argcount)
-        #                    for o in argv if type(o) is Option]
-    extras(help, version, argv, doc)
-    matched, left, collected = pattern.fix().match(argv)
-    if matched and left == []:  # better error message if left?
-        return Dict((a.name, a.value) for a in (pattern.flat() + collected))
-    raise DocoptExit()
+    return Parser(doc)(argv, help, version, options_first)
@@ -4,24 +4,66 @@
 """
 Get Unify's extranet timetables
 
-Usage: timetable [-h] [-j] [-c] [-m] [-s] [-u url] [-f FILE] [PERIOD]
+Usage: timetable [-h] [-j | -l | --ics] [-c | --format FMT] [-m] [-s]
+                 [-r | -o] [-t TTL] [-g GRACE] [--days DAYS]
+                 [-d | -w [-e CMD]] [-x FILE] [-u url] [-f FILE] [-i]
+                 [--timings] [--profile FILE] [PERIOD...]
 
 Arguments:
     PERIOD     Prints timetable for a given period
                Default is to print all available informations
                See the examples below for more precisions
+               Several periods are answered in separate sections
+               A period may also be a query combining today, tomorrow,
+               week, next-week, weekday names, dd/mm, dd/mm-dd/mm,
+               title:X, teacher:X, room:X, account:X or field:~regex
+               with and (implied), or, not and parentheses
 
 Options:
     -h, --help          Print this help and exit
     -j, --json          Print data in the JSON format
+    -l, --ndjson        Print one JSON course per line
+    --ics               Print data in the iCalendar format
     -c, --compact       Use a compact output format
+    --format FMT        Print each course through the FMT template, using
+                        {title} {teacher} {room} {account} {label} {period}
+                        {day} {hours} {start} and {end}
     -m, --manual        Do not use automatic login
     -s, --save          Save password to keyring.
                         Needs to be combined with --manual
+    -r, --refresh       Ignore the cached timetable and wait for it to be
+                        fetched again
+    -o, --offline       Only use the cached timetable, never fetch it
+    -t, --ttl TTL       Seconds before the cached timetable expires
+                        [default: 3600]
+    -g, --grace GRACE   Seconds after the TTL during which the expired
+                        timetable is still used, marked as stale, while it
+                        is refreshed in the background [default: 86400]
+    --days DAYS         Number of days fetched from today on, merged into
+                        the courses already cached [default: 7]
+    -d, --daemon        Keep the timetable in memory, refresh it every TTL
+                        seconds and answer other calls through a socket
+    -w, --watch         Keep running and print a line whenever a course
+                        starts or ends, reloading the timetable every TTL
+                        seconds
+    -e, --exec CMD      With --watch, run the CMD shell command for each
+                        event instead, with TIMETABLE_EVENT (start or end),
+                        TIMETABLE_TITLE, TIMETABLE_TEACHER, TIMETABLE_ROOM,
+                        TIMETABLE_PERIOD, TIMETABLE_START, TIMETABLE_END
+                        and TIMETABLE_ACCOUNT in its environment
+    -x, --export FILE   Write the whole timetable to FILE in the iCalendar
+                        format, only if it changed since the last export,
+                        instead of printing it. With --daemon or --watch,
+                        it is exported again each time it is reloaded
     -u, --url URL       Url of Unify's extranet
                         Default is in '~/.extranet'
     -f, --file FILE     Use FILE to find credential
                         Default is in '~/.extranet'
+                        With several accounts, their timetables are merged
+    -i, --stdin         Read one PERIOD per line on the standard input
+    --timings           Print the time spent in each phase of the run on
+                        stderr, as JSON with --json or --ndjson
+    --profile FILE      Save cProfile statistics of the run to FILE
 
 Examples:
     timetable  0        : print the current course
@@ -33,18 +75,52 @@ Examples:
     timetable  previous : print the previous course
     timetable  current  : print the current course
     timetable  dd/mm    : print the courses of given date
+    timetable  "next-week room:B12" : print next week's courses in B12
+    timetable  "week (monday or title:~^math)" : print this week's
+                          courses on monday or whose title starts with math
+    timetable  conflicts: print the courses overlapping another one
+    timetable  free     : print the free slots of the coming week
+    timetable  free:90  : print the free slots of 90 minutes or more
+    timetable  free:dd/mm-dd/mm:60 : print the free slots of an hour or
+                          more between two dates, of all the accounts
+    timetable  stats:room:dd/mm-dd/mm : print the hours spent in each room
+                          between two dates, or by title, teacher, week,
+                          day or hour, with NumPy if it is installed
+    timetable  today next tomorrow : print the three of them at once
 """
 
+import time
+
+# Taken before the other imports, for the imports phase of --timings
+STARTED = time.perf_counter()
+
+import io
 import os
 import re
 import sys
-import time
+import copy
+import mmap
+import array
+import fcntl
+import struct
+import json
+import bisect
+import signal
+import socket
+import heapq
+import string
+import hashlib
+import itertools
+import functools
 import datetime
 import getpass
-from docopt import docopt
-from extranet import Extranet
-from extranet.exceptions import *
-import keyring
+import contextlib
+import tempfile
+import threading
+import docopt
+
+# keyring and extranet (through requests) are slow to import, they are
+# only loaded on the code paths that really talk to them
 
 
 # To use french names
@@ -56,34 +132,380 @@ DAYS   = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
 MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
           "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 
-def print_courses(courses, *, compact=False, fmt=None):
+# Working days (monday is 0) and hours, looked at by "free" and "stats",
+# and shortest slot, in minutes, looked at by "free"
+WORK_DAYS    = {0, 1, 2, 3, 4}
+WORK_HOURS   = (datetime.time(8), datetime.time(18))
+FREE_MINIMUM = 30
+
+# Maximum number of accounts fetched at the same time
+FETCH_WORKERS = 4
+
+# Seconds the daemon waits for a client to send its query
+CLIENT_TIMEOUT = 5
+
+# Bump whenever the layout of cached timetables changes
+CACHE_VERSION = 2
+CACHE_DIR     = os.path.join(os.environ.get("XDG_CACHE_HOME")
+                             or os.path.join(os.environ["HOME"], ".cache"),
+                             "timetable")
+
+
+class Timings(object):
+    """
+    Time spent in each phase of a run, measured with a monotonic clock.
+    Phases entered several times, or from several threads, are added up.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.phases  = {}
+        self.lock    = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self, *, as_json=False, file=None):
+        total = time.perf_counter() - self.started
+        if as_json:
+            print(json.dumps({"phases": self.phases, "total": total}),
+                  file=file)
+            return
+
+        for name, seconds in self.phases.items():
+            print("%-10s %9.3f ms" % (name, seconds * 1000), file=file)
+        print("%-10s %9.3f ms" % ("total", total * 1000), file=file)
+
+
+TIMINGS = Timings(STARTED)
+
+class Course(object):
+    """
+    One course of a timetable, with integer timestamps and its period
+    text computed once. It can still be read like the dicts returned by
+    the extranet: course["title"], dict(course)...
+
+    When several accounts are merged, account tells whose course it is.
+    """
+
+    __slots__ = ("title", "teacher", "room", "start", "end",
+                 "start_ts", "end_ts", "account", "_period")
+
+    FIELDS = ("title", "teacher", "room", "start", "end")
+
+    def __init__(self, title, teacher, room, start_ts, end_ts, account=None):
+        self.title    = title
+        self.teacher  = teacher
+        self.room     = room
+        self.start_ts = start_ts
+        self.end_ts   = end_ts
+        self.start    = datetime.datetime.fromtimestamp(start_ts)
+        self.end      = datetime.datetime.fromtimestamp(end_ts)
+        self.account  = account
+        self._period  = None
+
+    @classmethod
+    def from_dict(cls, course):
+        return cls(course["title"], course.get("teacher", ""), course["room"],
+                   int(course["start"].timestamp()),
+                   int(course["end"].timestamp()))
+
+    @property
+    def period(self):
+        if self._period is None:
+            self._period = period(self.start, self.end)
+        return self._period
+
+    def keys(self):
+        return self.FIELDS
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def as_json(self):
+        course = {"title":   self.title,
+                  "teacher": self.teacher,
+                  "room":    self.room,
+                  "start":   self.start_ts,
+                  "end":     self.end_ts}
+        if self.account is not None:
+            course["account"] = self.account
+        return course
+
+    def __eq__(self, other):
+        if not isinstance(other, Course):
+            return NotImplemented
+        return self.as_json() == other.as_json()
+
+    def __repr__(self):
+        return "Course(%r, %r, %r, %r, %r)" % (self.title, self.teacher,
+                                               self.room, self.start_ts,
+                                               self.end_ts)
+
+
+def normalize(timetable):
+    """
+    Turns the dicts returned by the extranet into Courses, sorted
+    chronologically.
+    """
+    courses = [Course.from_dict(c) for c in timetable]
+    courses.sort(key=lambda c: c.start_ts)
+    return courses
+
+
+def print_courses(courses, *, compact=False, fmt=None, file=None):
     if fmt is None:
         if compact:
-            fmt = "{title}: {period}: {room}"
+            fmt = "{label}: {period}: {room}"
         else:
-            fmt = "{title}\n    {room}\n    {period}\n"
+            fmt = "{label}\n    {room}\n    {period}\n"
 
-    for c in courses:
-        print(fmt.format(title=c["title"],
-                         room=c["room"],
-                         period=period(c["start"], c["end"])))
+    renderer(fmt).write(courses, file)
+
+
+class Renderer(object):
+    """
+    Text output of courses through a str.format template. The template
+    is parsed once so that only the fields it uses are computed, and
+    lines are written by batches rather than one print() per course.
+    """
+
+    BATCH = 256
+
+    def __init__(self, fmt):
+        self.fmt     = fmt
+        self.getters = []
+
+        for _, name, _, _ in string.Formatter().parse(fmt):
+            if name is None:
+                continue
+            # Keep "title" of "{title[0]}" or "{start.year}"
+            field = re.match(r"[^.\[]*", name).group()
+            if field not in FORMAT_FIELDS:
+                raise ValueError("Unknown field in format: {%s}" % name)
+            if all(field != f for f, _ in self.getters):
+                self.getters.append((field, FORMAT_FIELDS[field]))
+
+        # Report bad conversions or format specs before any output
+        try:
+            self.line(Course("Title", "Teacher", "Room", 0, 3600))
+        except (LookupError, AttributeError, ValueError) as e:
+            raise ValueError("Invalid format: %s" % e)
+
+    def line(self, course):
+        return self.fmt.format_map({field: get(course)
+                                    for field, get in self.getters})
+
+    def write(self, courses, file=None):
+        if file is None:
+            file = sys.stdout
+        lines = map(self.line, courses)
+        while True:
+            batch = list(itertools.islice(lines, self.BATCH))
+            if not batch:
+                break
+            file.write("\n".join(batch) + "\n")
+
+
+def course_period(course):
+    if isinstance(course, Course):
+        return course.period
+    return period(course["start"], course["end"])
+
+
+def course_label(course):
+    account = getattr(course, "account", None)
+    if account is None:
+        return course["title"]
+    return "[%s] %s" % (account, course["title"])
+
+
+# Fields usable in --format templates
+FORMAT_FIELDS = {"title":   lambda c: c["title"],
+                 "teacher": lambda c: c["teacher"],
+                 "room":    lambda c: c["room"],
+                 "account": lambda c: getattr(c, "account", None) or "",
+                 "label":   course_label,
+                 "period":  course_period,
+                 "day":     lambda c: day_name(c["start"]),
+                 "hours":   lambda c: hours(c["start"], c["end"]),
+                 "start":   lambda c: c["start"],
+                 "end":     lambda c: c["end"]}
+
+
+@functools.lru_cache(maxsize=32)
+def renderer(fmt):
+    return Renderer(fmt)
+
+
+# Day part of the periods, computed once per day
+day_names = {}
+
+
+def day_name(start, *, days=DAYS, months=MONTHS):
+    # Only the default names are cached
+    cached = days is DAYS and months is MONTHS
+    key    = start.toordinal()
+    if cached and key in day_names:
+        return day_names[key]
+
+    name = "%s %d %s" % (days[start.weekday()], start.day,
+                         months[start.month-1])
+    if cached:
+        day_names[key] = name
+    return name
+
+
+def hours(start, end):
+    return "%dh%d-%dh%d" % (start.hour, start.minute, end.hour, end.minute)
 
 
 def period(start, end, *, days=DAYS, months=MONTHS):
-    return "{wday} {day} {mon}: {sh}h{sm}-{eh}h{em}".format(
-                wday = days[int(start.weekday())],
-                day  = start.day,
-                mon  = months[int(start.month)-1],
-                sh   = start.hour,
-                sm   = start.minute,
-                eh   = end.hour,
-                em   = end.minute)
+    return "%s: %s" % (day_name(start, days=days, months=months),
+                       hours(start, end))
 
 
 def now():
     return datetime.datetime.fromtimestamp(time.time())
 
 
+def midnight(day):
+    return datetime.datetime.combine(day, datetime.time()).timestamp()
+
+
+class TimetableIndex(object):
+    """
+    Sorted start and end timestamps of a timetable, answering range
+    queries by bisection against a single reference clock.
+
+    The timetable must already be sorted chronologically. Dicts as
+    returned by the extranet are turned into Courses, which queries read.
+    """
+
+    def __init__(self, timetable, now=None):
+        self.courses = timetable
+        self.now     = time.time() if now is None else now
+
+        if isinstance(timetable, (Store, Merged)):
+            # Bisect the columns of the file, reading no course
+            self.starts  = timetable.starts
+            self.ends    = timetable.ends
+            self.longest = timetable.longest
+            return
+
+        if not all(isinstance(c, Course) for c in timetable):
+            self.courses = timetable = [c if isinstance(c, Course)
+                                        else Course.from_dict(c)
+                                        for c in timetable]
+
+        self.starts = [c.start_ts for c in timetable]
+        self.ends   = [c.end_ts   for c in timetable]
+
+        # No course can be running if it started longer ago than this
+        self.longest = max((e - s for s, e in zip(self.starts, self.ends)),
+                           default=0)
+
+    def at(self, now):
+        """
+        Returns the same index using another reference clock.
+        """
+        index     = copy.copy(self)
+        index.now = now
+        return index
+
+    def current(self, num=1):
+        lo = bisect.bisect_left(self.starts, self.now - self.longest)
+        hi = bisect.bisect_left(self.starts, self.now)
+        return [self.courses[i] for i in range(lo, hi)
+                if self.now <= self.ends[i]][:num]
+
+    def next(self, num=1):
+        lo = bisect.bisect_left(self.starts, self.now)
+        return self.courses[lo:lo+num]
+
+    def previous(self, num=1):
+        """
+        Courses already over, the most recent first.
+        """
+        result = []
+        i      = bisect.bisect_left(self.starts, self.now) - 1
+
+        while i >= 0 and len(result) < num:
+            if self.ends[i] < self.now:
+                result.append(self.courses[i])
+            i -= 1
+
+        return result
+
+    def on(self, day):
+        """
+        Courses starting on the given calendar date.
+        """
+        lo = bisect.bisect_left(self.starts, midnight(day))
+        hi = bisect.bisect_left(self.starts,
+                                midnight(day + datetime.timedelta(days=1)))
+        return self.courses[lo:hi]
+
+    def events(self, after):
+        """
+        Heap of the (time, kind, row) boundaries of courses happening
+        after the given timestamp, kind being "end" or "start". Ends
+        come first when a course starts as another one ends.
+        """
+        events = []
+        for i in range(bisect.bisect_left(self.starts, after - self.longest),
+                       len(self.starts)):
+            if self.ends[i] > after:
+                events.append((self.ends[i], "end", i))
+            if self.starts[i] > after:
+                events.append((self.starts[i], "start", i))
+
+        heapq.heapify(events)
+        return events
+
+    def conflicts(self):
+        """
+        (earlier, later) row pairs of the courses not over yet which
+        overlap each other. A sweep over the start times keeps a heap of
+        the courses still running, in O(n log n + k) for k pairs.
+        """
+        pairs   = []
+        running = []
+
+        for i in range(bisect.bisect_left(self.starts,
+                                           self.now - self.longest),
+                       len(self.starts)):
+            if self.ends[i] < self.now:
+                continue
+            # Back to back courses do not overlap
+            while running and running[0][0] <= self.starts[i]:
+                heapq.heappop(running)
+            pairs.extend((j, i) for _, j in running)
+            heapq.heappush(running, (self.ends[i], i))
+
+        return pairs
+
+
+def as_index(timetable):
+    if isinstance(timetable, TimetableIndex):
+        return timetable
+    return TimetableIndex(timetable)
+
+
 # This function cannot be considered stable at this time, use with caution
 def courses_in_range(start, end, num, timetable):
     """
@@ -92,126 +514,1850 @@ def courses_in_range(start, end, num, timetable):
     of the courses.
 
     num is the maximum number of results wanted.
+
+    timetable is either a sorted list of courses or a TimetableIndex.
+    Courses selected by their end time are returned most recent first.
     """
-    result    = []
-    start_lim = start
-    end_lim   = end
+    index = as_index(timetable)
 
-    for course in timetable:
-        if num == 0:
+    if start == "start" and end == "end":
+        return index.current(num)
+
+    if end == "start" and type(start) != str:
+        return index.next(num) if start < index.now else []
+
+    if start == "end" and type(end) != str:
+        return index.previous(num) if index.now <= end else []
+
+    if type(start) != str and type(end) != str:
+        return index.courses[:num] if start < index.now <= end else []
+
+    result = []
+    for i, course in enumerate(index.courses):
+        if len(result) == num:
             break
 
+        start_lim = start
+        end_lim   = end
+
         if type(start) == str:
             start_lim = course[start].timestamp()
 
         if type(end) == str:
             end_lim = course[end].timestamp()
 
-        if start_lim < now().timestamp() <= end_lim:
+        if start_lim < index.now <= end_lim:
             result.append(course)
-            num -= 1
 
     return result
 
 
-def filter_dates(timetable, selection):
-    if selection is None:
-        return timetable
+def parse_day(selection, today):
+    """
+    Date given as "dd/mm", in the year that brings it closest to today
+    so that a semester spanning new year is handled naturally.
+    """
+    day, month = map(int, selection.split("/"))
 
-    if selection == "previous":
-        timetable.reverse()
-        return courses_in_range("end", now().timestamp(), 1, timetable)
+    candidates = []
+    for year in (today.year - 1, today.year, today.year + 1):
+        try:
+            candidates.append(datetime.date(year, month, day))
+        except ValueError:
+            pass
 
-    if selection == "current" or selection == "0":
-        return courses_in_range("start", "end", 1, timetable)
+    if not candidates:
+        sys.exit("Invalid date: " + selection)
 
-    if selection == "next":
-        return courses_in_range(0, "start", 1, timetable)
+    return min(candidates, key=lambda d: abs(d - today))
 
-    if selection == "today":
-        return [ x for x in timetable
-                if x["start"].day == now().day ]
 
+def conflicting(index):
+    """
+    Courses overlapping another one, double-booked rooms included. The
+    same course seen from several merged accounts is not a conflict.
+    """
+    rows = set()
+    for i, j in index.conflicts():
+        a, b = index.courses[i], index.courses[j]
+        if (a.title, a.room, a.start_ts, a.end_ts) \
+        != (b.title, b.room, b.start_ts, b.end_ts):
+            rows.update((i, j))
+
+    return [index.courses[i] for i in sorted(rows)]
+
+
+def free_slots(index, start, end, *, days=WORK_DAYS, hours=WORK_HOURS,
+               minimum=FREE_MINIMUM):
+    """
+    Yields the free slots between the start and end timestamps as
+    "Free" courses: the gaps between the courses of the timetable, of
+    all the merged accounts at once, within working days and hours and
+    lasting at least minimum minutes. Busy times are merged in a single
+    sweep over the sorted courses.
+    """
+    def within_hours(lo, hi):
+        day = datetime.date.fromtimestamp(lo)
+        while midnight(day) < hi:
+            if day.weekday() not in days:
+                day += datetime.timedelta(days=1)
+                continue
+            opens  = datetime.datetime.combine(day, hours[0]).timestamp()
+            closes = datetime.datetime.combine(day, hours[1]).timestamp()
+            slot   = (max(lo, opens), min(hi, closes))
+            if slot[1] > slot[0] and slot[1] - slot[0] >= minimum * 60:
+                yield Course("Free", "", "", int(slot[0]), int(slot[1]))
+            day += datetime.timedelta(days=1)
+
+    free = start
+    for i in range(bisect.bisect_left(index.starts, start - index.longest),
+                   bisect.bisect_left(index.starts, end)):
+        if index.ends[i] <= free:
+            continue
+        if index.starts[i] > free:
+            yield from within_hours(free, index.starts[i])
+        free = index.ends[i]
+
+    if free < end:
+        yield from within_hours(free, end)
+
+
+# "dd/mm" or "dd/mm-dd/mm"
+DAYS_RANGE = re.compile(r"([0-9]{1,2}/[0-9]{1,2})"
+                        r"(?:-([0-9]{1,2}/[0-9]{1,2}))?$")
+
+
+def parse_days(selection, today):
+    """
+    Range of days given as "today", "tomorrow", "dd/mm" or
+    "dd/mm-dd/mm", returned as the first and last day.
+    """
+    if selection == "today":
+        return today, today
     if selection == "tomorrow":
-        return [ x for x in timetable
-                if x["start"].day == (now().day + 1) ]
+        tomorrow = today + datetime.timedelta(days=1)
+        return tomorrow, tomorrow
 
-    if selection == "first":
-        return [ x for x in timetable
-                if x["start"].day == (now().day + 1) ][:1]
+    match = DAYS_RANGE.match(selection)
+    if match is None:
+        sys.exit("Invalid days: " + selection)
 
-    if re.match(r"[0-9]+$", selection):
-        n = int(selection)
-        return courses_in_range(0, "start", n, timetable)
+    return (parse_day(match.group(1), today),
+            parse_day(match.group(2) or match.group(1), today))
 
-    if re.match(r"[0-9]{1,2}/[0-9]{1,2}$", selection):
-        selected = selection.split("/")
-        return [x for x in timetable
-                if x["start"].day == int(selected[0])
-                and x["start"].month == int(selected[1])]
 
-    else:
-        sys.exit("Invalid command: " + selection)
+class Columns(object):
+    """
+    Columnar view of courses for the stats queries: start and end
+    timestamps, and integer codes of the titles, teachers and rooms
+    turned back into names by label(). The columns are NumPy arrays,
+    read in place from a Store, or from the Stores of merged accounts,
+    when NumPy is installed, and plain sequences otherwise. The same
+    course seen from several merged accounts is only counted once.
+    """
 
+    def __init__(self, index, lo, hi):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
 
-def converted_dates(timetable):
-    for course in timetable:
-        course["start"] = course["start"].timestamp()
-        course["end"]   = course["end"].timestamp()
+        self.numpy = numpy
+        timetable  = index.courses
+        convert    = list if numpy is None else numpy.asarray
 
-    return timetable
+        if isinstance(timetable, Store):
+            self.starts = convert(index.starts[lo:hi])
+            self.ends   = convert(index.ends[lo:hi])
+            self.codes  = {"title":   convert(timetable.titles[lo:hi]),
+                           "teacher": convert(timetable.teachers[lo:hi]),
+                           "room":    convert(timetable.rooms[lo:hi])}
+            self.label  = timetable.string
+            return
 
+        if (numpy is not None and isinstance(timetable, Merged)
+                and all(isinstance(t, Store) for t in timetable.timetables)):
+            self.merge_stores(timetable, lo, hi)
+            return
 
-def main():
-    args = docopt(__doc__)
+        # Intern the names of the other timetables, dropping the courses
+        # already seen from another account as conflicting() does
+        names, seen = {}, set()
+        self.starts, self.ends = [], []
+        self.codes = {field: [] for field in ("title", "teacher", "room")}
+        for i in range(lo, hi):
+            course = timetable[i]
+            key    = (course.title, course.room, course.start_ts,
+                      course.end_ts)
+            if key in seen:
+                continue
+            seen.add(key)
+            self.starts.append(course.start_ts)
+            self.ends.append(course.end_ts)
+            for field, codes in self.codes.items():
+                codes.append(names.setdefault(course[field], len(names)))
+        self.starts = convert(self.starts)
+        self.ends   = convert(self.ends)
+        self.codes  = {field: convert(codes)
+                       for field, codes in self.codes.items()}
+        self.label  = {code: name for name, code in names.items()}.get
 
-    cred_file = args["--file"] or "%s/.extranet" % os.environ["HOME"]
+    def merge_stores(self, merged, lo, hi):
+        """
+        Reads the rows lo to hi of merged Stores from their own columns,
+        their string codes being renumbered in a table shared by all.
+        """
+        numpy   = self.numpy
+        sources = numpy.asarray(merged.sources[lo:hi])
+        rows    = numpy.asarray(merged.rows[lo:hi])
+        starts  = numpy.asarray(merged.starts[lo:hi])
+        ends    = numpy.asarray(merged.ends[lo:hi])
 
-    if not os.path.exists(cred_file):
-        open(cred_file, 'w').close()
+        names = {}
+        codes = {field: numpy.zeros(len(rows), dtype="int64")
+                 for field in ("title", "teacher", "room")}
+        for n, store in enumerate(merged.timetables):
+            renumber = numpy.array([names.setdefault(store.string(i),
+                                                     len(names))
+                                    for i in range(len(store.offsets) - 1)],
+                                   dtype="int64")
+            mine = sources == n
+            for field, column in (("title",   store.titles),
+                                  ("teacher", store.teachers),
+                                  ("room",    store.rooms)):
+                codes[field][mine] = renumber[numpy.asarray(column)[
+                                                                rows[mine]]]
 
-    if args["--manual"]:
-        url      = input("Unify's extranet url: ")
-        username = input("Username: ")
-        password = getpass.getpass("Password: ")
-        if args["--save"]:
-            with open(cred_file, 'w') as f:
-                f.write(username + "\n" + url + "\n")
-                keyring.set_password("extranet", username+url, password)
+        # Drop the courses already seen from another account, keyed as
+        # in conflicting(), keeping the first of each in time order
+        keys = numpy.stack([starts, ends, codes["title"], codes["room"]],
+                           axis=1)
+        keep = numpy.sort(numpy.unique(keys, axis=0, return_index=True)[1])
+
+        self.starts = starts[keep]
+        self.ends   = ends[keep]
+        self.codes  = {field: column[keep] for field, column in codes.items()}
+        self.label  = {code: name for name, code in names.items()}.get
+
+    def buckets(self, edges):
+        """
+        Index of the [edges[k], edges[k+1]) interval of each start.
+        """
+        if self.numpy is not None:
+            return self.numpy.searchsorted(edges, self.starts,
+                                           side="right") - 1
+        return [bisect.bisect_right(edges, start) - 1
+                for start in self.starts]
+
+    def hours(self, edges):
+        """
+        Hour of the day of each start, edges being the midnights.
+        """
+        days = self.buckets(edges)
+        if self.numpy is not None:
+            edges = self.numpy.asarray(edges, dtype="int64")
+            return (self.starts - edges[days]) // 3600
+        return [int(start - edges[day]) // 3600
+                for start, day in zip(self.starts, days)]
+
+    def working(self, first, last, *, days=WORK_DAYS):
+        """
+        Whether each course starts on a working day, from the first to the
+        last day.
+        """
+        dates = [first + datetime.timedelta(days=n)
+                 for n in range((last - first).days + 2)]
+        flags = [date.weekday() in days for date in dates]
+        index = self.buckets([int(midnight(date)) for date in dates])
+        if self.numpy is not None:
+            return self.numpy.asarray(flags)[index]
+        return [flags[day] for day in index]
+
+    def grouped(self, keys, working):
+        """
+        Returns {key: (seconds, courses, working seconds)} of the courses
+        grouped by keys, the last being the time taken on working days.
+        """
+        if self.numpy is not None:
+            if len(keys) == 0:
+                return {}
+            durations = self.ends - self.starts
+            seconds   = self.numpy.bincount(keys, weights=durations)
+            worked    = self.numpy.bincount(keys,
+                                            weights=durations * working)
+            courses   = self.numpy.bincount(keys)
+            return {int(key): (float(seconds[key]), int(courses[key]),
+                               float(worked[key]))
+                    for key in courses.nonzero()[0]}
+
+        groups = {}
+        for key, start, end, flag in zip(keys, self.starts, self.ends,
+                                         working):
+            seconds, courses, worked = groups.get(key, (0, 0, 0))
+            groups[key] = (seconds + end - start, courses + 1,
+                           worked + (end - start if flag else 0))
+        return groups
+
+
+def working_seconds(first, last, *, days=WORK_DAYS, hours=WORK_HOURS):
+    """
+    Working time of the working days from first to last, included.
+    """
+    opens  = datetime.datetime.combine(first, hours[0])
+    closes = datetime.datetime.combine(first, hours[1])
+    count  = sum((first + datetime.timedelta(days=n)).weekday() in days
+                 for n in range((last - first).days + 1))
+    return count * (closes - opens).total_seconds()
+
+
+def stats(index, group, first, last):
+    """
+    Returns (name, seconds, courses, usage) rows of the courses starting
+    from the first to the last day, grouped by title, teacher, room,
+    week, day or hour of the day. usage is the share of the working time
+    taken by the courses of the working days, None by hour.
+    """
+    lo = bisect.bisect_left(index.starts, midnight(first))
+    hi = bisect.bisect_left(index.starts,
+                            midnight(last + datetime.timedelta(days=1)))
+    columns = Columns(index, lo, hi)
+    working = columns.working(first, last)
+
+    if group in columns.codes:
+        available = working_seconds(first, last)
+        groups    = columns.grouped(columns.codes[group], working)
+        return [(columns.label(key), seconds, courses,
+                 worked / available if available else None)
+                for key, (seconds, courses, worked)
+                in sorted(groups.items(), key=lambda item: -item[1][0])]
+
+    if group not in ("week", "day", "hour"):
+        sys.exit("Invalid stats: " + group)
+
+    step = 7 if group == "week" else 1
+    days = [first - datetime.timedelta(days=first.weekday() if step == 7
+                                       else 0)]
+    while days[-1] <= last:
+        days.append(days[-1] + datetime.timedelta(days=step))
+    edges = [int(midnight(day)) for day in days]
+
+    if group == "hour":
+        groups = columns.grouped(columns.hours(edges), working)
+        return [("%dh" % key, seconds, courses, None)
+                for key, (seconds, courses, _) in sorted(groups.items())]
+
+    rows   = []
+    groups = columns.grouped(columns.buckets(edges), working)
+    for key, (seconds, courses, worked) in sorted(groups.items()):
+        # The first and last weeks may be cut by the range of days
+        end       = days[key+1] - datetime.timedelta(days=1)
+        available = working_seconds(max(days[key], first), min(end, last))
+        rows.append((day_name(days[key]), seconds, courses,
+                     worked / available if available else None))
+    return rows
+
+
+def stats_query(index, selection):
+    """
+    Rows answering "stats[:GROUP][:DAYS]", GROUP defaulting to title
+    and DAYS to all the days of the timetable.
+    """
+    _, group, days = (selection.split(":", 2) + ["", ""])[:3]
+    today = datetime.date.fromtimestamp(index.now)
 
+    if days:
+        first, last = parse_days(days, today)
+    elif len(index.starts):
+        first = datetime.date.fromtimestamp(index.starts[0])
+        last  = datetime.date.fromtimestamp(index.starts[-1])
     else:
-        with open(cred_file) as f:
-            username,url = f.read().splitlines()
-            password = keyring.get_password("extranet", username+url)
+        first = last = today
 
+    return stats(index, group or "title", first, last)
 
-    try:
-        timetable = Extranet(url, username, password).get_timetable()
-    except LoginError:
-        exit("Wrong login\n"
-           + "If no password has been saved yet, please, try:\n"
-           + "    timetable.py -ms")
 
-    except ConnectionError:
-        exit("Cannot establish a connection to server")
+class Query(object):
+    """
+    Compiled PERIOD query: a window of start times and a predicate on
+    the courses inside it, both computed once from the current day:
+    window(today) returns the (lo, hi) bounds and predicate(today) the
+    test of a course. Either may be None, meaning no restriction.
+    Evaluating a query bisects the timetable to the window and only
+    tests the courses within.
+    """
+
+    def __init__(self, window=None, predicate=None):
+        self.window    = window
+        self.predicate = predicate
 
-    except FatalError:
-        exit("An unexpected error happened")
+    def matches(self, today):
+        """
+        Returns the test of a course against both the window and the
+        predicate, as needed when the query is combined with "or" or
+        negated.
+        """
+        test = None if self.predicate is None else self.predicate(today)
+        if self.window is None:
+            return test or (lambda c: True)
+
+        lo, hi = self.window(today)
+        if test is None:
+            return lambda c: lo <= c.start_ts < hi
+        return lambda c: lo <= c.start_ts < hi and test(c)
+
+    def __and__(self, other):
+        a, b = self, other
+
+        if a.window is None or b.window is None:
+            window = a.window or b.window
+        else:
+            def window(today):
+                (alo, ahi), (blo, bhi) = a.window(today), b.window(today)
+                return max(alo, blo), min(ahi, bhi)
+
+        if a.predicate is None or b.predicate is None:
+            predicate = a.predicate or b.predicate
+        else:
+            def predicate(today):
+                atest, btest = a.predicate(today), b.predicate(today)
+                return lambda c: atest(c) and btest(c)
+
+        return Query(window, predicate)
+
+    def __or__(self, other):
+        a, b = self, other
+
+        if a.window is None or b.window is None:
+            window = None
+        else:
+            def window(today):
+                (alo, ahi), (blo, bhi) = a.window(today), b.window(today)
+                return min(alo, blo), max(ahi, bhi)
+
+        def predicate(today):
+            atest, btest = a.matches(today), b.matches(today)
+            return lambda c: atest(c) or btest(c)
+
+        return Query(window, predicate)
+
+    def __invert__(self):
+        def predicate(today):
+            test = self.matches(today)
+            return lambda c: not test(c)
+
+        return Query(None, predicate)
+
+    def __call__(self, index):
+        today  = datetime.date.fromtimestamp(index.now)
+        lo, hi = 0, len(index.starts)
+        if self.window is not None:
+            start, end = self.window(today)
+            lo = bisect.bisect_left(index.starts, start)
+            hi = max(lo, bisect.bisect_left(index.starts, end))
+
+        courses = index.courses[lo:hi]
+        if self.predicate is None:
+            return courses
+        test = self.predicate(today)
+        return [c for c in courses if test(c)]
+
+
+def days_window(first, last):
+    """
+    Query window of the days returned by first(today) and last(today).
+    """
+    return Query(lambda today: (midnight(first(today)),
+                                midnight(last(today)
+                                         + datetime.timedelta(days=1))))
 
-    except ValueError as e:
-        exit("If no password has been saved yet, please, try:\n"
-           + "    timetable.py -ms")
 
-    # Sort timetable chronologically
-    timetable.sort(key=lambda x: x["start"].timestamp())
+def week_window(weeks):
+    """
+    Query window of the week starting weeks mondays after this one.
+    """
+    def monday(today):
+        return today + datetime.timedelta(days=7 * weeks - today.weekday())
+    return days_window(monday,
+                       lambda today: monday(today)
+                                   + datetime.timedelta(days=6))
+
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday",
+            "saturday", "sunday"]
+
+QUERY_TOKEN = re.compile(r'\s*(?:([()])|(\w+):(~?)"((?:[^"\\]|\\.)*)"'
+                         r'|([^\s()]+))')
+
+
+def parse_term(word):
+    """
+    Compiles a single word of a query.
+    """
+    one_day = datetime.timedelta(days=1)
+
+    if word == "today":
+        return days_window(lambda today: today, lambda today: today)
+
+    if word == "tomorrow":
+        return days_window(lambda today: today + one_day,
+                           lambda today: today + one_day)
+
+    if word == "week":
+        return week_window(0)
+
+    if word == "next-week":
+        return week_window(1)
+
+    names = [name.lower() for name in DAYS]
+    if word in WEEKDAYS or word in names:
+        weekday = (WEEKDAYS.index(word) if word in WEEKDAYS
+                   else names.index(word))
+        return Query(None, lambda today:
+                               lambda c: c.start.weekday() == weekday)
+
+    match = DAYS_RANGE.match(word)
+    if match:
+        first, last = match.group(1), match.group(2) or match.group(1)
+        return days_window(lambda today: parse_day(first, today),
+                           lambda today: parse_day(last, today))
+
+    match = re.match(r"(title|teacher|room|account):(~?)(.*)$", word)
+    if match:
+        return parse_field(*match.groups())
 
-    timetable = filter_dates(timetable, args["PERIOD"])
+    sys.exit("Invalid command: " + word)
 
 
-    if args["--json"]:
-        print(converted_dates(timetable))
+def parse_field(field, regex, value):
+    """
+    Compiles a field:value word, matching the value case insensitively,
+    or the regular expression with field:~regex.
+    """
+    if regex:
+        try:
+            pattern = re.compile(value, re.IGNORECASE)
+        except re.error as e:
+            sys.exit("Invalid regex %r: %s" % (value, e))
+        test = lambda c: pattern.search(getattr(c, field) or "") is not None
     else:
-        print_courses(timetable, compact=args["--compact"])
+        value = value.casefold()
+        test  = lambda c: (getattr(c, field) or "").casefold() == value
+
+    return Query(None, lambda today: test)
+
+
+def parse_query(selection):
+    """
+    Compiles a PERIOD query: words combined with "and", which may be left
+    out, "or", "not" and parentheses, in this order of priority. A value
+    with spaces or parentheses is written field:"value".
+    """
+    tokens = []
+    pos    = 0
+    while selection[pos:].strip():
+        match = QUERY_TOKEN.match(selection, pos)
+        paren, field, regex, quoted, word = match.groups()
+        if quoted is not None:
+            word = "%s:%s%s" % (field, regex,
+                                re.sub(r"\\(.)", r"\1", quoted))
+        tokens.append(paren or word)
+        pos = match.end()
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def alternatives():
+        query = conjunction()
+        while peek() == "or":
+            tokens.pop(0)
+            query = query | conjunction()
+        return query
+
+    def conjunction():
+        query = negation()
+        while peek() not in (None, "or", ")"):
+            if peek() == "and":
+                tokens.pop(0)
+            query = query & negation()
+        return query
+
+    def negation():
+        if peek() == "not":
+            tokens.pop(0)
+            return ~negation()
+        if peek() == "(":
+            tokens.pop(0)
+            query = alternatives()
+            if peek() != ")":
+                sys.exit("Missing ) in: " + selection)
+            tokens.pop(0)
+            return query
+        if peek() in (None, ")", "and", "or"):
+            sys.exit("Invalid command: " + selection)
+        word = tokens.pop(0)
+        # Keep the case of field values
+        return parse_term(word if ":" in word else word.lower())
+
+    query = alternatives()
+    if tokens:
+        sys.exit("Invalid command: " + selection)
+    return query
+
+
+def parse_free(days, minimum):
+    """
+    Compiles "free[:DAYS][:MINUTES]", see free_slots. DAYS may be left
+    empty, or out when only MINUTES is given.
+    """
+    if minimum is None and days is not None and days.isdigit():
+        days, minimum = None, days
+    days    = days or None
+    minimum = int(minimum or FREE_MINIMUM)
+
+    def free(index):
+        today = datetime.date.fromtimestamp(index.now)
+        if days is None:
+            first, last = today, today + datetime.timedelta(days=6)
+        else:
+            first, last = parse_days(days, today)
+        return free_slots(index,
+                          max(index.now, midnight(first)),
+                          midnight(last + datetime.timedelta(days=1)),
+                          minimum=minimum)
+
+    return free
+
+
+# Selectors which are not queries, answered by a method of the index
+SELECTORS = {
+    "previous":  lambda index: index.previous(),
+    "current":   lambda index: index.current(),
+    "0":         lambda index: index.current(),
+    "next":      lambda index: index.next(),
+    "first":     lambda index: index.on(datetime.date.fromtimestamp(
+                                 index.now) + datetime.timedelta(days=1))[:1],
+    "conflicts": conflicting,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_selection(selection):
+    """
+    Returns the function answering the selection from an index, parsed
+    only once however many times it is asked.
+    """
+    if selection in SELECTORS:
+        return SELECTORS[selection]
+
+    if re.match(r"[0-9]+$", selection):
+        return lambda index: index.next(int(selection))
+
+    match = re.match(r"free(?::([^:]*))?(?::([0-9]+))?$", selection)
+    if match:
+        return parse_free(*match.groups())
+
+    return parse_query(selection)
+
+
+def filter_dates(timetable, selection):
+    index = as_index(timetable)
+
+    if selection is None:
+        return index.courses
+
+    return compile_selection(selection)(index)
+
+
+def converted_dates(timetable, *, stale=False):
+    """
+    Yields copies of the courses with timestamps instead of datetimes,
+    leaving the timetable untouched. Courses of a timetable older than
+    the cache TTL are marked with a "stale" key.
+    """
+    for course in timetable:
+        if isinstance(course, Course):
+            course = course.as_json()
+        else:
+            course = dict(course, start=course["start"].timestamp(),
+                                  end=course["end"].timestamp())
+        if stale:
+            course["stale"] = True
+        yield course
+
+
+def print_json(courses, *, ndjson=False, tag=None, stale=False, file=None):
+    """
+    Writes courses as a JSON array, or as one JSON object per line with
+    ndjson, encoding each course as it comes. With a tag, every object
+    gets a "query" key.
+    """
+    file = sys.stdout if file is None else file
+
+    if ndjson:
+        for course in converted_dates(courses, stale=stale):
+            if tag is not None:
+                course["query"] = tag
+            file.write(json.dumps(course) + "\n")
+        return
+
+    sep = "["
+    for course in converted_dates(courses, stale=stale):
+        file.write(sep + json.dumps(course))
+        sep = ",\n "
+    file.write("[]\n" if sep == "[" else "]\n")
+
+
+def ics_time(timestamp):
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(timestamp))
+
+
+def ics_text(text):
+    for char, escaped in (("\\", "\\\\"), (";", "\\;"), (",", "\\,"),
+                          ("\n", "\\n")):
+        text = text.replace(char, escaped)
+    return text
+
+
+def ics_fold(line):
+    """
+    Splits a content line in lines of at most 75 octets, as iCalendar
+    requires, continued lines starting with a space.
+    """
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line + "\r\n"
+
+    lines = []
+    while data:
+        size = 75 if not lines else 74
+        # Do not cut a multibyte character
+        while size < len(data) and data[size] & 0xC0 == 0x80:
+            size -= 1
+        lines.append(data[:size].decode("utf-8"))
+        data = data[size:]
+    return "\r\n ".join(lines) + "\r\n"
+
+
+def print_ics(courses, *, file=None):
+    """
+    Writes courses as an iCalendar document, one VEVENT at a time.
+    """
+    file  = sys.stdout if file is None else file
+    stamp = ics_time(time.time())
+
+    file.write("BEGIN:VCALENDAR\r\n"
+               "VERSION:2.0\r\n"
+               "PRODID:-//timetable//Unify extranet//EN\r\n")
+
+    for c in courses:
+        uid = hashlib.sha1(repr((c.start_ts, c.end_ts, c.title, c.room,
+                                 c.account)).encode("utf-8")).hexdigest()
+        summary = c.title if c.account is None else course_label(c)
+
+        file.write("BEGIN:VEVENT\r\n"
+                   + "UID:%s@timetable\r\n" % uid
+                   + "DTSTAMP:%s\r\n" % stamp
+                   + "DTSTART:%s\r\n" % ics_time(c.start_ts)
+                   + "DTEND:%s\r\n" % ics_time(c.end_ts)
+                   + ics_fold("SUMMARY:" + ics_text(summary))
+                   + ics_fold("LOCATION:" + ics_text(c.room))
+                   + ics_fold("DESCRIPTION:" + ics_text(c.teacher))
+                   + "END:VEVENT\r\n")
+
+    file.write("END:VCALENDAR\r\n")
+
+
+def export_ics(path, courses):
+    """
+    Writes the iCalendar export of courses to path, unless the content
+    hash saved in path.etag by the previous export shows that they did
+    not change. Returns whether the file was written.
+    """
+    h = hashlib.sha1()
+    for c in courses:
+        h.update(repr((c.start_ts, c.end_ts, c.title, c.teacher, c.room,
+                       c.account)).encode("utf-8"))
+    etag = h.hexdigest()
+
+    try:
+        with open(path + ".etag") as f:
+            if f.read() == etag and os.path.exists(path):
+                return False
+    except OSError:
+        pass
+
+    # Replaced atomically, calendar clients may be reading it
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            print_ics(courses, file=f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+    with open(path + ".etag", "w") as f:
+        f.write(etag)
+    return True
+
+
+def show(courses, *, as_json=False, ndjson=False, ics=False, compact=False,
+         fmt=None, stale=False, file=None):
+    if ics:
+        print_ics(courses, file=file)
+    elif as_json or ndjson:
+        print_json(courses, ndjson=ndjson, stale=stale, file=file)
+    else:
+        print_courses(courses, compact=compact, fmt=fmt, file=file)
+
+
+def show_query(index, selection, *, tagged=False, as_json=False,
+               ndjson=False, ics=False, compact=False, fmt=None, stale=False,
+               file=None):
+    """
+    Prints the courses selected by one PERIOD. When several of them are
+    answered at once, tagged output tells them apart: a header before
+    each section, one {"query", "courses"} JSON object per line, a
+    "query" key in every NDJSON course, or one calendar each.
+    """
+    if selection is not None and selection.split(":")[0] == "stats":
+        with TIMINGS.phase("stats"):
+            rows = stats_query(index, selection)
+        with TIMINGS.phase("print"):
+            print_stats(rows, selection, tagged=tagged, as_json=as_json,
+                        ndjson=ndjson, stale=stale, file=file)
+        return
+
+    with TIMINGS.phase("filter"):
+        courses = filter_dates(index, selection)
+
+    with TIMINGS.phase("print"):
+        render_query(courses, selection, tagged=tagged, as_json=as_json,
+                     ndjson=ndjson, ics=ics, compact=compact, fmt=fmt,
+                     stale=stale, file=file)
+
+
+def render_query(courses, selection, *, tagged, as_json, ndjson, ics,
+                 compact, fmt, stale, file):
+    if not tagged or ics:
+        show(courses, as_json=as_json, ndjson=ndjson, ics=ics,
+             compact=compact, fmt=fmt, stale=stale, file=file)
+
+    elif ndjson:
+        print_json(courses, ndjson=True, tag=selection, stale=stale,
+                   file=file)
+
+    elif as_json:
+        tagged = {"query":   selection,
+                  "courses": list(converted_dates(courses, stale=stale))}
+        if stale:
+            tagged["stale"] = True
+        print(json.dumps(tagged), file=file)
+
+    else:
+        print("== %s ==" % selection, file=file)
+        show(courses, compact=compact, fmt=fmt, file=file)
+
+
+def print_stats(rows, selection, *, tagged, as_json, ndjson, stale, file):
+    """
+    Prints the rows of a stats query, tagged like courses.
+    """
+    objects = [{"name":    name,
+                "hours":   seconds / 3600,
+                "courses": courses,
+                "usage":   usage} for name, seconds, courses, usage in rows]
+    for row in objects:
+        if stale:
+            row["stale"] = True
+        if ndjson and tagged:
+            row["query"] = selection
+
+    if ndjson:
+        for row in objects:
+            print(json.dumps(row), file=file)
+
+    elif as_json and tagged:
+        print(json.dumps({"query": selection, "stats": objects}), file=file)
+
+    elif as_json:
+        print(json.dumps(objects), file=file)
+
+    else:
+        if tagged:
+            print("== %s ==" % selection, file=file)
+        for name, seconds, courses, usage in rows:
+            line = "%s: %.1fh, %d courses" % (name, seconds / 3600, courses)
+            if usage is not None:
+                line += ", %d%% of working hours" % round(usage * 100)
+            print(line, file=file)
+
+
+def cache_path(username, url, ext=".store"):
+    key = hashlib.sha1((username + url).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key + ext)
+
+
+class Store(object):
+    """
+    Timetable saved in a compact binary file and read through mmap.
+
+    The file holds a header, then one column per field: start and end
+    timestamps as int64, title, teacher and room as uint32 indexes in a
+    table of interned strings. Columns use the native byte order. Only
+    the rows actually read are turned into course dicts, and the
+    timestamp columns can be bisected in place. Rows are read as Courses.
+    """
+
+    MAGIC  = b"TTBL"
+    # magic, version, courses, strings, fetch time, longest course, padding
+    HEADER  = struct.Struct("<4sIIIdd4x")
+    FETCHED = 16
+    # start, end, title, teacher and room of one course
+    ROW     = struct.Struct("=qqIII")
+    # Strings no course refers to kept by merge before renumbering them
+    UNUSED  = 256
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, count, nstrings,
+         self.fetched, self.longest) = self.HEADER.unpack_from(self.map)
+
+        if magic != self.MAGIC or version != CACHE_VERSION:
+            raise ValueError("Not a timetable store: " + path)
+
+        # A truncated file must not be read with the counts of its header
+        columns = self.HEADER.size + count * self.ROW.size + 4 * (nstrings+1)
+        if len(self.map) < columns:
+            raise ValueError("Truncated timetable store: " + path)
+
+        view   = memoryview(self.map)
+        offset = self.HEADER.size
+
+        def column(typecode, length):
+            nonlocal offset
+            size    = length * struct.calcsize(typecode)
+            column  = view[offset:offset+size].cast(typecode)
+            offset += size
+            return column
+
+        self.starts   = column("q", count)
+        self.ends     = column("q", count)
+        self.titles   = column("I", count)
+        self.teachers = column("I", count)
+        self.rooms    = column("I", count)
+        self.offsets  = column("I", nstrings + 1)
+        self.blob     = offset
+        self.strings  = {}
+
+        if self.blob + self.offsets[-1] != len(self.map):
+            raise ValueError("Truncated timetable store: " + path)
+
+        # Set when the timetable is older than the cache TTL
+        self.stale    = False
+        # Set to tag the courses when several accounts are merged
+        self.account  = None
+
+    @staticmethod
+    def save(path, timetable, fetched):
+        """
+        Writes a normalized timetable of Courses as a store at path.
+        """
+        Store.merge(path, None, [(0, 0, timetable)], fetched)
+
+    @staticmethod
+    def merge(path, store, replacements, fetched):
+        """
+        Writes at path a copy of store where, for each (lo, hi, courses)
+        of replacements, the rows lo to hi are replaced by the normalized
+        courses. Kept rows are copied as raw bytes and the strings of
+        store keep their indexes, so nothing is re-sorted or decoded,
+        until more than UNUSED strings are left unreferenced and the
+        string table is rebuilt. replacements must be sorted and disjoint. store may be None, in
+        which case they must all be (0, 0, courses).
+        """
+        columns = ("starts", "ends", "titles", "teachers", "rooms")
+        chunks  = {column: [] for column in columns}
+        strings = {}
+        encoded = []
+        offsets = array.array("I", [0])
+        count   = 0
+        longest = 0
+
+        if store is not None:
+            nstrings = len(store.offsets) - 1
+            strings  = {store.string(i): i for i in range(nstrings)}
+            encoded  = [store.map[store.blob:store.blob+store.offsets[-1]]]
+            offsets  = array.array("I", store.offsets)
+            longest  = store.longest
+
+        def intern(string):
+            if string not in strings:
+                strings[string] = len(strings)
+                encoded.append(string.encode("utf-8"))
+                offsets.append(offsets[-1] + len(encoded[-1]))
+            return strings[string]
+
+        end  = 0 if store is None else len(store)
+        kept = 0
+        for lo, hi, courses in replacements + [(end, end, [])]:
+            for column in columns:
+                if store is not None:
+                    chunks[column].append(getattr(store, column)[kept:lo])
+
+            chunks["starts"].append(array.array("q", (c.start_ts
+                                                      for c in courses)))
+            chunks["ends"].append(array.array("q", (c.end_ts
+                                                    for c in courses)))
+            for column, field in (("titles",   "title"),
+                                  ("teachers", "teacher"),
+                                  ("rooms",    "room")):
+                chunks[column].append(array.array("I", (
+                    intern(getattr(c, field)) for c in courses)))
+
+            longest = max([longest] + [c.end_ts - c.start_ts
+                                       for c in courses])
+            count  += lo - kept + len(courses)
+            kept    = hi
+
+        codes = ("titles", "teachers", "rooms")
+        used  = set()
+        for column in codes:
+            for chunk in chunks[column]:
+                used.update(chunk)
+
+        if len(strings) - len(used) > Store.UNUSED:
+            blob     = b"".join(encoded)
+            renumber = {}
+            encoded  = []
+            for code in sorted(used):
+                renumber[code] = len(renumber)
+                encoded.append(blob[offsets[code]:offsets[code+1]])
+            offsets  = array.array("I", [0])
+            for string in encoded:
+                offsets.append(offsets[-1] + len(string))
+            for column in codes:
+                chunks[column] = [array.array("I", (renumber[code]
+                                                    for code in chunk))
+                                  for chunk in chunks[column]]
+
+        with open(path, "wb") as f:
+            f.write(Store.HEADER.pack(Store.MAGIC, CACHE_VERSION, count,
+                                      len(offsets) - 1, fetched, longest))
+            for column in columns:
+                for chunk in chunks[column]:
+                    f.write(chunk)
+            f.write(offsets.tobytes())
+            for string in encoded:
+                f.write(string)
+
+    @staticmethod
+    def touch(path, fetched):
+        """
+        Updates the fetch time of the store at path in place.
+        """
+        with open(path, "r+b") as f:
+            f.seek(Store.FETCHED)
+            f.write(struct.pack("<d", fetched))
+
+    def string(self, i):
+        if i not in self.strings:
+            start = self.blob + self.offsets[i]
+            end   = self.blob + self.offsets[i+1]
+            self.strings[i] = self.map[start:end].decode("utf-8")
+        return self.strings[i]
+
+    def course(self, i):
+        return Course(self.string(self.titles[i]),
+                      self.string(self.teachers[i]),
+                      self.string(self.rooms[i]),
+                      self.starts[i],
+                      self.ends[i],
+                      self.account)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.course(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("course index out of range")
+        return self.course(i)
+
+    def __iter__(self):
+        return (self.course(i) for i in range(len(self)))
+
+
+class Merged(object):
+    """
+    Several sorted timetables seen as a single one in chronological
+    order, with the same columns as a Store. Courses are only read from
+    their own timetable on access.
+    """
+
+    def __init__(self, timetables):
+        self.timetables = timetables
+        self.starts     = array.array("q")
+        self.ends       = array.array("q")
+        self.sources    = array.array("I")
+        self.rows       = array.array("I")
+        self.longest    = max(t.longest for t in timetables)
+        self.stale      = any(t.stale for t in timetables)
+
+        # k-way merge of the already sorted start columns
+        columns = [zip(t.starts, itertools.repeat(n), itertools.count())
+                   for n, t in enumerate(timetables)]
+        for start, source, row in heapq.merge(*columns):
+            self.starts.append(start)
+            self.ends.append(timetables[source].ends[row])
+            self.sources.append(source)
+            self.rows.append(row)
+
+    def course(self, i):
+        return self.timetables[self.sources[i]].course(self.rows[i])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.course(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("course index out of range")
+        return self.course(i)
+
+    def __iter__(self):
+        return (self.course(i) for i in range(len(self)))
+
+
+def load_cache(path):
+    """
+    Returns (timetable, fetch time) or None if there is no usable cache.
+    """
+    try:
+        store = Store(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    return store, store.fetched
+
+
+def save_cache(path, timetable, *, base=None, replacements=None):
+    """
+    Atomically replaces the cached copy so that a concurrent reader
+    never sees a partially written file. With a base store, only the
+    given replacements are applied to it (see Store.merge).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        if base is None:
+            Store.save(tmp, timetable, time.time())
+        else:
+            Store.merge(tmp, base, replacements, time.time())
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def weeks(start, end):
+    """
+    Splits the [start, end) timestamps range at each monday midnight.
+    """
+    day = datetime.date.fromtimestamp(start)
+    while start < end:
+        day += datetime.timedelta(days=7 - day.weekday())
+        yield start, min(end, midnight(day))
+        start = midnight(day)
+
+
+def content_hash(courses):
+    h = hashlib.sha1()
+    for c in courses:
+        h.update(repr((c.start_ts, c.end_ts,
+                       c.title, c.teacher, c.room)).encode("utf-8"))
+    return h.digest()
+
+
+def sync_cache(path, store, timetable, start, end):
+    """
+    Merges the normalized timetable, fetched for the [start, end) range,
+    into the cached store. Courses are compared week by week and only the
+    weeks whose content changed are replaced, the rest of the store is
+    kept as is. Courses outside of the range, like past ones which the
+    extranet does not send anymore, are never removed.
+    """
+    if store is None:
+        save_cache(path, timetable)
+        return
+
+    if timetable:
+        start = min(start, timetable[0].start_ts)
+        end   = max(end,   timetable[-1].start_ts + 1)
+
+    fetched_starts = [c.start_ts for c in timetable]
+    replacements   = []
+
+    for week_start, week_end in weeks(start, end):
+        lo = bisect.bisect_left(store.starts, week_start)
+        hi = bisect.bisect_left(store.starts, week_end)
+
+        fetched = timetable[bisect.bisect_left(fetched_starts, week_start):
+                            bisect.bisect_left(fetched_starts, week_end)]
+
+        if content_hash(fetched) != content_hash(store[lo:hi]):
+            replacements.append((lo, hi, fetched))
+
+    if replacements:
+        save_cache(path, None, base=store, replacements=replacements)
+    else:
+        Store.touch(path, time.time())
+
+
+def load_session(path):
+    """
+    Returns the cookies saved at path, or None when there is none or
+    when the login cookie has expired.
+    """
+    try:
+        with open(path) as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    now     = time.time()
+    cookies = [c for c in cookies
+                 if c["expires"] is None or c["expires"] > now]
+    if not any(c["name"] == "extranet_db" for c in cookies):
+        return None
+
+    return cookies
+
+
+def save_session(path, cookies):
+    """
+    Atomically saves the cookies of an authenticated session, readable
+    by the user only.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # mkstemp creates the file with 0600 permissions
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump([{"name":    c.name,
+                        "value":   c.value,
+                        "domain":  c.domain,
+                        "path":    c.path,
+                        "expires": c.expires,
+                        "secure":  c.secure} for c in cookies], f)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def fetch_timetable(url, username, password, days=7, session=None):
+    """
+    Fetches the timetable of the coming days. password is a function,
+    only called when a login is needed: the session saved at the
+    session path is tried first, and saved again after a new login.
+    """
+    with TIMINGS.phase("imports"):
+        import requests
+        from extranet import Extranet
+        from extranet.extranet import UA_STRING
+        from extranet.exceptions import ConnectionError, LoginError
+
+    # Shared by both attempts so that the connection is kept alive
+    http = requests.Session()
+    http.headers.update({"User-Agent": UA_STRING})
+
+    cookies = session and load_session(session)
+    if cookies:
+        extranet = Extranet(url, username)
+        extranet.session = http
+        for c in cookies:
+            http.cookies.set(c["name"], c["value"], domain=c["domain"],
+                             path=c["path"], expires=c["expires"],
+                             secure=c["secure"])
+        extranet.connected = extranet.logged = True
+        try:
+            with TIMINGS.phase("fetch"):
+                return extranet.get_timetable(days)
+        # Skipping the login also skips the connection test, which is
+        # where extranet turns requests errors into its own
+        except requests.RequestException as e:
+            raise ConnectionError from e
+        # An expired session is answered with the login page
+        except (LoginError, ValueError):
+            http.cookies.clear()
+
+    with TIMINGS.phase("keyring"):
+        password = password()
+
+    try:
+        extranet = Extranet(url, username, password)
+        extranet.session = http
+        with TIMINGS.phase("login"):
+            extranet.login()
+        with TIMINGS.phase("fetch"):
+            timetable = extranet.get_timetable(days)
+    except requests.RequestException as e:
+        raise ConnectionError from e
+
+    except LoginError:
+        exit("Wrong login\n"
+           + "If no password has been saved yet, please, try:\n"
+           + "    timetable.py -ms")
+
+    except ValueError as e:
+        exit("If no password has been saved yet, please, try:\n"
+           + "    timetable.py -ms")
+
+    if session:
+        save_session(session, http.cookies)
+    return timetable
+
+
+def refresh_cache(path, fetch, store, days):
+    """
+    Fetches the courses of the coming days and merges them into the
+    cached store, returning the updated one.
+    """
+    # The extranet sends the courses from today's midnight on
+    today = datetime.date.today()
+    fetched = fetch(days)
+
+    with TIMINGS.phase("sort"):
+        timetable = normalize(fetched)
+
+    with TIMINGS.phase("sync"):
+        sync_cache(path, store, timetable,
+                   midnight(today),
+                   midnight(today + datetime.timedelta(days=days)))
+
+        # Always serve the stored copy, it is sorted and lighter
+        store = load_cache(path)[0]
+
+    return store
+
+
+def refresh_in_background(path, fetch, store, days):
+    """
+    Refreshes the cache from a detached process, at most one at a time.
+    The process is forked twice so that long running callers, like
+    --watch, are not left with zombies to reap.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    child = os.fork()
+    if child != 0:
+        os.waitpid(child, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            refresh_cache(path, fetch, store, days)
+    except BaseException:
+        os._exit(1)
+    os._exit(0)
+
+
+def load_timetable(path, fetch, *, ttl, grace=0, days=7, refresh=False,
+                   offline=False, on_stale=refresh_in_background):
+    """
+    Returns the timetable sorted chronologically, read from the cache at
+    path while it is younger than ttl seconds. Otherwise fetch(days) gets
+    the courses of the coming days, which are merged into the cache.
+    Either way it is a Store, whose courses are only read on access.
+
+    For grace more seconds, the expired cache is still answered at once
+    while on_stale(path, fetch, store, days) refreshes it in the
+    background. A timetable older than ttl has its stale attribute set.
+    """
+    with TIMINGS.phase("cache"):
+        cached = load_cache(path)
+    age    = None if cached is None else time.time() - cached[1]
+
+    if offline:
+        if cached is None:
+            exit("No cached timetable available")
+        timetable       = cached[0]
+        timetable.stale = age >= ttl
+
+    elif cached is not None and not refresh and age < ttl:
+        timetable = cached[0]
+
+    elif cached is not None and not refresh and age < ttl + grace:
+        print("Using a timetable fetched %d minutes ago, "
+              % (age // 60) + "refreshing it in the background",
+              file=sys.stderr)
+        timetable       = cached[0]
+        timetable.stale = True
+        on_stale(path, fetch, timetable, days)
+
+    else:
+        with TIMINGS.phase("imports"):
+            from extranet.exceptions import ConnectionError, FatalError
+
+        try:
+            timetable = refresh_cache(path, fetch, cached and cached[0], days)
+
+        except ConnectionError:
+            if cached is None:
+                exit("Cannot establish a connection to server")
+            print("Cannot establish a connection to server, "
+                  + "using the cached timetable", file=sys.stderr)
+            timetable       = cached[0]
+            timetable.stale = True
+
+        except FatalError:
+            if cached is None:
+                exit("An unexpected error happened")
+            print("An unexpected error happened, "
+                  + "using the cached timetable", file=sys.stderr)
+            timetable       = cached[0]
+            timetable.stale = True
+
+    return timetable
+
+
+def load_accounts(accounts, **options):
+    """
+    Loads the timetable of each (username, url, fetch) account through
+    load_timetable, fetching them in parallel, and merges them with each
+    course tagged by its account. A failing account is reported on
+    stderr without stopping the others.
+    """
+    if len(accounts) == 1:
+        username, url, fetch = accounts[0]
+        return load_timetable(cache_path(username, url), fetch, **options)
+
+    stale = []
+
+    def load(account):
+        username, url, fetch = account
+        try:
+            timetable = load_timetable(cache_path(username, url), fetch,
+                                       on_stale=lambda *a: stale.append(a),
+                                       **options)
+        except SystemExit as e:
+            print("%s: %s" % (username, e.code), file=sys.stderr)
+            return None
+
+        timetable.account = username
+        return timetable
+
+    import concurrent.futures
+
+    workers = min(len(accounts), FETCH_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        timetables = [t for t in pool.map(load, accounts) if t is not None]
+
+    # Forking is only safe once the other threads are done
+    for refresh in stale:
+        refresh_in_background(*refresh)
+
+    if not timetables:
+        exit("No timetable could be loaded")
+
+    return Merged(timetables)
+
+
+def answer(index, query, *, file=None):
+    """
+    Renders the reply to a query, either sent to the daemon or answered
+    locally. An invalid PERIOD does not prevent answering the others.
+    Local answers are written to file as they are rendered, the daemon's
+    are kept in the output of the reply when file is None.
+    """
+    out    = io.StringIO() if file is None else file
+    errors = []
+    stale  = getattr(index.courses, "stale", False)
+
+    for selection in query["periods"]:
+        try:
+            show_query(index, selection,
+                       tagged=query["tagged"],
+                       as_json=query["json"],
+                       ndjson=query["ndjson"],
+                       ics=query["ics"],
+                       compact=query["compact"],
+                       fmt=query["format"],
+                       stale=stale,
+                       file=out)
+        except SystemExit as e:
+            errors.append(str(e.code))
+
+    return {"output": out.getvalue() if file is None else "",
+            "error":  "\n".join(errors) or None}
+
+
+def serve(path, load, interval):
+    """
+    Answers queries on the unix socket at path from a timetable kept in
+    memory, reloading it through load() every interval seconds. A failed
+    reload keeps answering from the previous timetable.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+        try:
+            probe.connect(path)
+        except FileNotFoundError:
+            pass
+        except ConnectionRefusedError:
+            # A previous daemon was killed without cleaning up
+            os.unlink(path)
+        else:
+            sys.exit("A daemon is already listening on " + path)
+
+    index     = TimetableIndex(load(refresh=False))
+    refreshed = time.time()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen()
+
+        while True:
+            if time.time() >= refreshed + interval:
+                try:
+                    index = TimetableIndex(load(refresh=True))
+                # fetch_timetable exits on a wrong login
+                except (SystemExit, Exception) as e:
+                    print("Cannot reload the timetable: %s"
+                          % getattr(e, "code", e), file=sys.stderr)
+                refreshed = time.time()
+
+            # Only a null interval is already over once reloaded
+            remaining = refreshed + interval - time.time()
+            server.settimeout(remaining if remaining > 0 else None)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+
+            with conn:
+                # A client that never ends its query must not stall the others
+                conn.settimeout(CLIENT_TIMEOUT)
+                try:
+                    query = json.loads(recv_all(conn).decode("utf-8"))
+                    reply = answer(index.at(time.time()), query)
+                except OSError:
+                    continue
+                # A bad query must not stop the daemon
+                except (ValueError, KeyError, TypeError,
+                        AttributeError) as e:
+                    reply = {"output": "",
+                             "error":  "Invalid query: %r" % e}
+                try:
+                    conn.sendall(json.dumps(reply).encode("utf-8"))
+                except OSError:
+                    pass
+
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def recv_all(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def query_daemon(path, query):
+    """
+    Returns the daemon's reply or None if no daemon is listening on path.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(path)
+        except OSError:
+            return None
+
+        client.sendall(json.dumps(query).encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        return json.loads(recv_all(client).decode("utf-8"))
+
+
+def watch(load, interval, emit):
+    """
+    Calls emit(kind, course) when a course starts or ends, sleeping until
+    the next of these boundaries. The timetable is reloaded through
+    load() every interval seconds in a background thread, so that a slow
+    fetch does not delay the events, the cache being refreshed in the
+    background once it expires. A failed reload keeps the previous one.
+    """
+    index  = TimetableIndex(load(refresh=False))
+    synced = last = time.time()
+    events = index.events(last)
+
+    reloaded  = threading.Event()
+    loaded    = []
+    reloading = False
+
+    def reload():
+        try:
+            loaded.append(TimetableIndex(load(refresh=False)))
+        # fetch_timetable exits on a wrong login
+        except (SystemExit, Exception) as e:
+            print("Cannot reload the timetable: %s" % getattr(e, "code", e),
+                  file=sys.stderr)
+        reloaded.set()
+
+    while True:
+        now = time.time()
+
+        if reloaded.is_set():
+            reloaded.clear()
+            reloading = False
+            if loaded:
+                index  = loaded.pop()
+                events = index.events(last)
+
+        if not reloading and now >= synced + interval:
+            synced    = now
+            reloading = True
+            threading.Thread(target=reload, daemon=True).start()
+
+        while events and events[0][0] <= now:
+            last, kind, row = heapq.heappop(events)
+            emit(kind, index.courses[row])
+
+        # A reload in progress wakes the loop up when it is done
+        wake = None if reloading else synced + interval
+        if events:
+            wake = events[0][0] if wake is None else min(wake, events[0][0])
+        reloaded.wait(None if wake is None else max(0, wake - time.time()))
+
+
+def watcher(args):
+    """
+    Returns the emit function of watch() for the given options: it
+    prints one line per event, or runs the --exec command.
+    """
+    children = []
+
+    def run_hook(kind, course):
+        env = dict(os.environ,
+                   TIMETABLE_EVENT   = kind,
+                   TIMETABLE_TITLE   = course.title,
+                   TIMETABLE_TEACHER = course.teacher,
+                   TIMETABLE_ROOM    = course.room,
+                   TIMETABLE_PERIOD  = course.period,
+                   TIMETABLE_START   = str(course.start_ts),
+                   TIMETABLE_END     = str(course.end_ts),
+                   TIMETABLE_ACCOUNT = course.account or "")
+        import subprocess
+
+        # Reap the hooks already done without waiting for the others
+        children[:] = [c for c in children if c.poll() is None]
+        children.append(subprocess.Popen(args["--exec"], shell=True,
+                                         env=env))
+
+    def print_event(kind, course):
+        if args["--json"] or args["--ndjson"]:
+            print(json.dumps(dict(course.as_json(), event=kind)))
+        else:
+            fmt = args["--format"] or "{label}: {period}: {room}"
+            print(kind + " " + renderer(fmt).line(course))
+        sys.stdout.flush()
+
+    return print_event if args["--exec"] is None else run_hook
+
+
+def main():
+    TIMINGS.add("imports", time.perf_counter() - STARTED)
+
+    with TIMINGS.phase("docopt"):
+        # The parsed usage is kept next to the cached timetables
+        args = docopt.compile(__doc__, cache_dir=CACHE_DIR)()
+
+    try:
+        if args["--profile"] is None:
+            run(args)
+        else:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(run, args)
+            finally:
+                profile.dump_stats(args["--profile"])
+    except BrokenPipeError:
+        # The reader, e.g. head, stopped before the end of the output
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if args["--timings"]:
+            sys.stdout.flush()
+            TIMINGS.report(as_json=args["--json"] or args["--ndjson"],
+                           file=sys.stderr)
+
+
+def run(args):
+    cred_file = args["--file"] or "%s/.extranet" % os.environ["HOME"]
+
+    if not os.path.exists(cred_file):
+        open(cred_file, 'w').close()
+
+    with open(cred_file) as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+
+    # One username line followed by one url line per account
+    saved = list(zip(lines[0::2], lines[1::2]))
+
+    if args["--manual"]:
+        url      = input("Unify's extranet url: ")
+        username = input("Username: ")
+        password = getpass.getpass("Password: ")
+        if args["--save"]:
+            import keyring
+            if (username, url) not in saved:
+                with open(cred_file, 'a') as f:
+                    f.write(username + "\n" + url + "\n")
+            keyring.set_password("extranet", username+url, password)
+
+        fetch = lambda days: fetch_timetable(url, username, lambda: password,
+                                             days,
+                                             cache_path(username, url,
+                                                        ".session"))
+        accounts = [(username, url, fetch)]
+
+    elif not saved:
+        exit("No saved credentials, please, try:\n"
+           + "    timetable.py -ms")
+
+    else:
+        # Only look the password up when the extranet is really queried
+        def fetcher(username, url):
+            def fetch(days):
+                def password():
+                    import keyring
+                    return keyring.get_password("extranet", username+url)
+                return fetch_timetable(url, username, password, days,
+                                       cache_path(username, url, ".session"))
+            return fetch
+
+        accounts = [(username, url, fetcher(username, url))
+                    for username, url in saved]
+
+    query = {"periods": args["PERIOD"] or [None],
+             "tagged":  len(args["PERIOD"]) > 1 or args["--stdin"],
+             "json":    args["--json"],
+             "ndjson":  args["--ndjson"],
+             "ics":     args["--ics"],
+             "compact": args["--compact"],
+             "format":  args["--format"]}
+    sock  = cache_path("".join(u + l for u, l, _ in accounts), "", ".sock")
+
+    if args["--format"] is not None:
+        try:
+            renderer(args["--format"])
+        except ValueError as e:
+            exit(e)
+
+    if args["--stdin"]:
+        # Answer each selector as soon as it is read
+        queries = (dict(query, periods=[line.strip()])
+                   for line in sys.stdin if line.strip())
+    else:
+        queries = iter([query])
+
+    failed = False
+
+    def reply_with(ask):
+        nonlocal failed
+        for query in queries:
+            reply = ask(query)
+            if reply is None:
+                # Not answered, leave it to the next method
+                return query
+            with TIMINGS.phase("print"):
+                sys.stdout.write(reply["output"])
+                sys.stdout.flush()
+            if reply["error"] is not None:
+                print(reply["error"], file=sys.stderr)
+                failed = True
+
+    if not (args["--manual"] or args["--daemon"] or args["--watch"]
+            or args["--refresh"] or args["--export"]):
+        with TIMINGS.phase("daemon"):
+            unanswered = reply_with(lambda query: query_daemon(sock, query))
+        if unanswered is None:
+            sys.exit(failed)
+        queries = itertools.chain([unanswered], queries)
+
+    load = lambda refresh: load_accounts(accounts,
+                                         ttl=float(args["--ttl"]),
+                                         grace=float(args["--grace"]),
+                                         days=int(args["--days"]),
+                                         refresh=refresh or args["--refresh"],
+                                         offline=args["--offline"])
+
+    if args["--export"] is not None:
+        load_courses = load
+
+        # Export the timetable whenever it is loaded
+        def load(refresh):
+            timetable = load_courses(refresh)
+            with TIMINGS.phase("export"):
+                export_ics(args["--export"], timetable)
+            return timetable
+
+    if args["--watch"]:
+        try:
+            watch(load, float(args["--ttl"]), watcher(args))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args["--daemon"]:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Let serve() remove its socket when the daemon is stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            serve(sock, load, float(args["--ttl"]))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    timetable = load(refresh=False)
+    if args["--export"] is not None:
+        return
+
+    with TIMINGS.phase("index"):
+        index = TimetableIndex(timetable)
+
+    reply_with(lambda query: answer(index.at(time.time()), query,
+                                    file=sys.stdout))
+    sys.exit(failed)
 
 
 if __name__ == "__main__":